@@ -0,0 +1,99 @@
+from typing import *
+
+from log import *
+
+
+# access control
+
+class AccessControl:
+    def __init__(self,
+        admins:Iterable[int]=config.ADMINS,
+        use_whitelist:bool=config.USE_WHITELIST,
+        use_write_whitelist:bool=config.USE_WRITE_WHITELIST
+    ):
+        '''
+        Decides whether users can use the bot and write to it.
+
+        Users are looked up in sets and decisions are cached
+        per user until the lists change.
+        '''
+        self.admins: Set[int] = set(admins) # users that are always allowed
+        self.use_whitelist: bool = use_whitelist # whether the read list is a whitelist
+        self.use_write_whitelist: bool = use_write_whitelist # whether the write list is a whitelist
+
+        self.read: Set[int] = set() # users in the blacklist/whitelist
+        self.write: Set[int] = set() # users in the write blacklist/whitelist
+        self.decisions: Dict[int, Tuple[str, str]] = {} # cached read and write errors of users
+
+    def load(self, read:Iterable[int], write:Iterable[int]):
+        '''
+        Replaces both lists and drops all cached decisions.
+        '''
+        self.read = set(read)
+        self.write = set(write)
+        self.decisions.clear()
+
+    def update(self, ids:Iterable[int], read:bool=None, write:bool=None):
+        '''
+        Adds users to lists or removes them from lists and
+        drops their cached decisions.
+
+        `True` adds users to a list, `False` removes them
+        and `None` leaves the list as it is.
+        '''
+        for id in ids:
+            if read != None:
+                (self.read.add if read else self.read.discard)(id)
+            if write != None:
+                (self.write.add if write else self.write.discard)(id)
+
+            self.decisions.pop(id, None)
+
+    def decide(self, id:int) -> Tuple[str, str]:
+        '''
+        Returns errors that prevent the user from using the bot
+        and from writing to it. An error is None if the action is allowed.
+        '''
+        if id in self.decisions:
+            return self.decisions[id]
+
+        read_error = None
+        write_error = None
+
+        if id not in self.admins: # все равны но админы ровнее
+            # blacklist
+            if not self.use_whitelist and id in self.read:
+                read_error = 'Пользователь в черном списке'
+
+            # whitelist
+            if self.use_whitelist and id not in self.read:
+                read_error = 'Пользователь не в белом списке'
+
+            # write blacklist
+            if not self.use_write_whitelist and id in self.write:
+                write_error = 'Нет прав для записи - Пользователь в чёрном списке'
+
+            # write whitelist
+            if self.use_write_whitelist and id not in self.write:
+                write_error = 'Нет прав для записи - Пользователь не в белом списке'
+
+        self.decisions[id] = (read_error, write_error)
+        return self.decisions[id]
+
+    def check(self, id:int, write_action:bool=False) -> str:
+        '''
+        Returns an error if the user can't perform the action,
+        otherwise returns None.
+        '''
+        read_error, write_error = self.decide(id)
+
+        if read_error or not write_action:
+            return read_error
+        return write_error
+
+    def can_write(self, id:int) -> bool:
+        '''
+        Returns whether the user can write to the bot
+        (like writing homework etc.).
+        '''
+        return self.decide(id)[1] == None
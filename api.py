@@ -5,14 +5,80 @@ import datetime
 import json
 from log import *
 import utils
+import db
+import backup
+import search
+import acl
+import heapq
+import bisect
 import time
 from aiogram.types import User as AiogramUser
 import random
+import asyncio
+import weakref
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+
+
+# database entry
+
+class Entry:
+    collection: str = None # name of the collection the entry is stored in
+    fields: List[str] = [] # names of the fields stored in the database
+
+    def __init__(self):
+        '''
+        Base class for objects stored in the database.
+
+        Keeps track of which stored fields were changed since the
+        last commit. Freshly created entries have all of their
+        fields marked as changed.
+        '''
+        self.dirty_fields: Set[str] = set() # stored fields changed since the last commit
+        self.on_change: Callable[[Entry], None] = None # called right before a clean entry gets changed
+
+    def __setattr__(self, name:str, value:Any):
+        # marking before assigning so listeners can see the old values
+        if name in self.fields:
+            self.mark_dirty(name)
+
+        super().__setattr__(name, value)
+
+    def mark_dirty(self, *fields:str):
+        '''
+        Marks stored fields as changed.
+
+        Use this when mutating a field in place, like
+        appending to a list. Such changes can't be rolled back
+        by transactions, so prefer assigning a new value.
+        '''
+        if not self.dirty_fields and self.on_change:
+            self.on_change(self)
+
+        self.dirty_fields.update(fields)
+
+    def clean(self, fields:Iterable[str]=None):
+        '''
+        Marks stored fields (all if not specified) as unchanged.
+        '''
+        if fields == None:
+            self.dirty_fields.clear()
+        else:
+            self.dirty_fields.difference_update(fields)
+
+    def dirty_dict(self) -> dict:
+        '''
+        Converts only the changed fields to a dictionary.
+        '''
+        return {k: v for k, v in self.to_dict().items() if k in self.dirty_fields}
 
 
 # homework entry
 
-class HomeworkEntry:
+class HomeworkEntry(Entry):
+    collection = 'homework'
+    fields = ['lesson', 'text', 'attachment', 'written_at', 'written_by']
+
     def __init__(self,
         id:str, lesson:str, text:str,
         attachment:str,
@@ -21,6 +87,7 @@ class HomeworkEntry:
         '''
         A homework entry.
         '''
+        super().__init__()
         self.id: str = id # homework ID
         self.lesson: str = lesson # lesson ID
         self.text: str = text # homework text
@@ -43,7 +110,10 @@ class HomeworkEntry:
 
 # attachment
 
-class Attachment:
+class Attachment(Entry):
+    collection = 'attachments'
+    fields = ['filename', 'lesson', 'comment', 'written_at', 'written_by']
+
     def __init__(
         self, id:str, filename:str, lesson:str,
         comment:str, written_at:float, written_by:int
@@ -51,6 +121,7 @@ class Attachment:
         '''
         Represents an attachment to a homework assignment.
         '''
+        super().__init__()
         self.id: str = id # attachment ID
         self.filename: str = filename # attachment file
         self.lesson: str = lesson # lesson
@@ -115,6 +186,8 @@ class Event:
         self.length: int = data['length'] # length of the event
         self.length_seconds: int = data['length']*60 # length of event in seconds
         self.name: str = data['name'] # lesson name (None if no lesson for this event)
+        self.substituted: bool = data.get('substituted', False) # whether the lesson was changed by a substitution
+        self.replaced: str = data.get('replaced', None) # lesson name before the substitution
         
         self.start_timestamp: int = start_timestamp # start timestamp
         self.end_timestamp: int = start_timestamp+self.length_seconds # end timestamp
@@ -124,7 +197,10 @@ class Event:
 
 
 class Day:
-    def __init__(self, begin_time:datetime.datetime, lessons:List[str], schedule:List[dict]):
+    def __init__(self,
+        begin_time:datetime.datetime, lessons:List[str],
+        schedule:List[dict], weekday:int=None
+    ):
         '''
         Represents a single day in the schedule.
         '''
@@ -132,10 +208,12 @@ class Day:
             "Too few lesson events in schedule data"
 
         self.lessons: List[str] = lessons # list of lessons
+        self.lesson_ids: Dict[str, None] = dict.fromkeys(lessons) # set of lessons, in order
         self.schedule: List[dict] = schedule # schedule data
         self.begin_time: datetime.datetime = begin_time # time when lessons begin
         self.begin_timestamp: int = begin_time.timestamp() # timestamp when lessons begin 
-        self.weekday = begin_time.weekday()
+        self.weekday: int = weekday # weekday index of the day
+        self.substitution: Substitution = None # changes applied to the day
 
         self.events: List[Event] = []
         event_time = int(self.begin_timestamp)
@@ -148,12 +226,13 @@ class Day:
                     event_time+i['length']*60
                 )
 
+            # pasting in lesson info
+            # the schedule data is shared between days so it's copied
             if not i['break'] and lesson_index < len(lessons):
-                # pasting in lesson info
-                i['name'] = self.lessons[lesson_index]
+                i = {**i, 'name': self.lessons[lesson_index]}
                 lesson_index += 1
             else:
-                i['name'] = None
+                i = {**i, 'name': None}
 
             self.events.append(Event(event_time, i))
             event_time += i['length']*60 # because time in schedule data is in minutes
@@ -162,51 +241,224 @@ class Day:
         self.end_time = datetime.datetime.fromtimestamp(self.end_timestamp)
 
 
-# current time data
+# substitutions
 
-class Time:
-    def __init__(self, day:Day, weekday_index:int):
+class Substitution:
+    def __init__(self, date:datetime.date, data:dict):
         '''
-        Contains current time info, like is the school going right now,
-        the time until the next event, etc.
+        Represents changes to the schedule on a specific date.
         '''
-        self.time = datetime.datetime.now()
-        self.weekday: int = day.weekday
+        self.date: datetime.date = date # date of the changes
+        self.lessons: Dict[int, str] = {
+            int(k): v for k, v in data.get('lessons', {}).items()
+        } # new lesson IDs by lesson numbers, None cancels the lesson
+        self.start_time: List[int] = data.get('start_time', None) # shifted start time, 1st value is hours, 2nd is minutes
+        self.comment: str = data.get('comment', None) # note shown with the schedule
 
-        time_td = utils.to_td(self.time)
-        start_td = utils.to_td(day.begin_time)
-        end_td = utils.to_td(day.end_time)
-        
-        self.is_school: bool = (weekday_index == self.weekday)\
-            and ((start_td < time_td) and (end_td > time_td))
-        self.event: Event = None # the current event of the day
-        self.event_index: int = None # the index of the event in the day
-        self.event_number: int = None # the number of the event like 5th break or 1st lesson
-        self.time_remaining: int = None # time remaining until next event
 
-        if self.is_school:
+class DayOverlay(Day):
+    def __init__(self, base:Day, substitution:Substitution):
+        '''
+        A `Day` with a substitution applied on top of it.
+
+        `Day.__init__` is not called - only the changed events
+        are created, everything else is shared with the base day,
+        which is left untouched.
+        '''
+        self.base: Day = base # day without the substitution
+        self.substitution: Substitution = substitution # changes applied to the day
+        self.date: datetime.date = substitution.date # date of the day
+        self.weekday: int = base.weekday # weekday index of the day
+        self.schedule: List[dict] = base.schedule # schedule data
+
+        # shifting the start
+        shift = 0
+        if substitution.start_time != None:
+            hours, minutes = substitution.start_time
+            shift = hours*60*60 + minutes*60 - utils.to_td(base.begin_time)
+
+        self.begin_time: datetime.datetime = base.begin_time+datetime.timedelta(seconds=shift) # time when lessons begin
+        self.begin_timestamp: int = base.begin_timestamp+shift # timestamp when lessons begin
+
+        # replacing lessons
+        self.events: List[Event] = []
+        lessons: List[str] = []
+        number = 0
+
+        for i in base.events:
+            name = i.name
+            if not i.is_break:
+                number += 1
+                name = substitution.lessons.get(number, i.name)
+                lessons.append(name)
+
+            if shift == 0 and name == i.name:
+                self.events.append(i)
+                continue
+
+            self.events.append(Event(i.start_timestamp+shift, {
+                'break': i.is_break, 'length': i.length, 'name': name,
+                'substituted': name != i.name,
+                'replaced': i.name if name != i.name else None
+            }))
+
+        while lessons and lessons[-1] == None:
+            lessons.pop()
+
+        self.lessons: List[str] = lessons # list of lessons, None for cancelled ones
+        self.lesson_ids: Dict[str, None] = dict.fromkeys(i for i in lessons if i != None) # set of lessons, in order
+
+        # the day now ends with its last lesson that's left
+        self.lesson_end_timestamp: int = int(self.begin_timestamp)
+        for i in self.events:
+            if not i.is_break and i.name != None:
+                self.lesson_end_timestamp = i.end_timestamp
+        self.lesson_end_time = datetime.datetime.fromtimestamp(self.lesson_end_timestamp)
+
+        self.end_timestamp: int = base.end_timestamp+shift
+        self.end_time = datetime.datetime.fromtimestamp(self.end_timestamp)
+
+
+# weekly timeline
+
+WEEK_SECONDS = 7*24*60*60 # length of a week in seconds
+
+class Timeline:
+    def __init__(self, schedule:List[Day]):
+        '''
+        The whole weekly schedule compiled into sorted arrays of
+        seconds from the beginning of the week, so finding the
+        current or the next event is a binary search.
+
+        Only events from the first lesson of the day to the end
+        of its last lesson are included.
+        '''
+        self.starts: List[int] = [] # start of each event
+        self.ends: List[int] = [] # end of each event
+        self.events: List[Tuple[int, int, int, Event]] = [] # weekday, index in day, number of lesson or break and each event
+
+        self.lesson_starts: List[int] = [] # start of each lesson
+        self.lessons: List[Tuple[int, Event]] = [] # weekday and each lesson
+
+        self.day_starts: List[int] = [] # start of each day with lessons
+        self.days: List[int] = [] # weekday of each day with lessons
+
+        for weekday, day in enumerate(schedule):
+            if len(day.lessons) == 0:
+                continue
+
+            day_start = weekday*24*60*60 + utils.to_td(day.begin_time)
             breaks_thru = 0
             lessons_thru = 0
-            lessons = len(day.lessons)
 
             for index, i in enumerate(day.events):
-                cur_td = utils.to_td(i.start_time)
+                if i.start_timestamp >= day.lesson_end_timestamp:
+                    break
 
                 if i.is_break: breaks_thru += 1
                 else: lessons_thru += 1
 
-                if cur_td+i.length_seconds > time_td:
-                    self.event_index = index
-                    self.event = i
-                    self.event_number = breaks_thru if i.is_break else lessons_thru
-                    self.time_remaining = (i.length_seconds+cur_td)-time_td
-                    break
+                # the day starts with its first lesson that's not cancelled
+                if len(self.days) == 0 or self.days[-1] != weekday:
+                    if i.is_break or i.name == None:
+                        continue
+                    self.day_starts.append(day_start + int(i.start_timestamp-day.begin_timestamp))
+                    self.days.append(weekday)
 
-                if lessons_thru > lessons:
-                    self.is_school = False
-                    break
-            else:
-                self.is_school = False
+                start = day_start + int(i.start_timestamp-day.begin_timestamp)
+                self.starts.append(start)
+                self.ends.append(start+i.length_seconds)
+                self.events.append((
+                    weekday, index, breaks_thru if i.is_break else lessons_thru, i
+                ))
+
+                if not i.is_break and i.name != None:
+                    self.lesson_starts.append(start)
+                    self.lessons.append((weekday, i))
+
+    @staticmethod
+    def to_seconds(time:datetime.datetime) -> int:
+        '''
+        Converts the datetime object into an amount of seconds
+        elapsed from the beginning of the week.
+        '''
+        return time.weekday()*24*60*60 + utils.to_td(time)
+
+    @staticmethod
+    def find_next(starts:List[int], seconds:int) -> Tuple[int, int]:
+        '''
+        Returns the index of the first start that is not earlier
+        than the given time, wrapping around the week, and the
+        amount of seconds until it.
+
+        Returns None, None if there are no starts.
+        '''
+        if not starts:
+            return None, None
+
+        index = bisect.bisect_left(starts, seconds)
+        if index == len(starts):
+            return 0, starts[0]+WEEK_SECONDS-seconds
+
+        return index, starts[index]-seconds
+
+    def event_at(self, seconds:int) -> int:
+        '''
+        Returns the index of the event going on at the given time.
+
+        Returns None if there's no school at that time.
+        '''
+        index = bisect.bisect_right(self.starts, seconds)-1
+
+        if index < 0 or seconds >= self.ends[index]:
+            return None
+        return index
+
+    def until_school(self, seconds:int) -> int:
+        '''
+        Returns the amount of seconds from the given time until
+        the next day of lessons begins, or None if all lessons
+        of the week are cancelled.
+        '''
+        return self.find_next(self.day_starts, seconds)[1]
+
+    def next_lesson(self, seconds:int) -> Tuple[int, int, Event]:
+        '''
+        Returns the amount of seconds from the given time until
+        the next lesson starts, its weekday and the lesson itself.
+
+        Returns None, None, None if all lessons of the week
+        are cancelled.
+        '''
+        index, until = self.find_next(self.lesson_starts, seconds)
+        if index == None:
+            return None, None, None
+        return (until, *self.lessons[index])
+
+
+# current time data
+
+class Time:
+    def __init__(self, timeline:Timeline, time:datetime.datetime=None):
+        '''
+        Contains current time info, like is the school going right now,
+        the time until the next event, etc.
+        '''
+        self.time = time if time != None else datetime.datetime.now()
+        self.weekday: int = self.time.weekday()
+        seconds = Timeline.to_seconds(self.time)
+        index = timeline.event_at(seconds)
+
+        self.is_school: bool = index != None
+        self.event: Event = None # the current event of the day
+        self.event_index: int = None # the index of the event in the day
+        self.event_number: int = None # the number of the event like 5th break or 1st lesson
+        self.time_remaining: int = None # time remaining until next event
+        self.time_until_school: int = timeline.until_school(seconds) # time remaining until the next day of lessons begins, None if there are none this week
+
+        if self.is_school:
+            _, self.event_index, self.event_number, self.event = timeline.events[index]
+            self.time_remaining = timeline.ends[index]-seconds
 
 
 # user data
@@ -245,7 +497,13 @@ class Slot:
         }
                 
 
-class User:
+class User(Entry):
+    collection = 'users'
+    fields = [
+        'full_name', 'handle', 'balance', 'daily_until', 'max_slots', 'slots',
+        'company_name', 'company_handle', 'handle_change_free', 'notifications'
+    ]
+
     def __init__(
         self, id:int, full_name:str, handle:str,
         balance:int=config.DEFAULT_BALANCE,
@@ -255,11 +513,13 @@ class User:
         company_name:str=None,
         company_handle:str=None,
         handle_change_free:bool=True,
+        notifications:List[int]=[],
         **kwargs
     ):
         '''
         A user entry in a database
         '''
+        super().__init__()
         self.id: int = int(id) # telegram user id
         self.full_name: str = full_name # telegram account name and surname
         self.handle: str = handle # telegram username, can be none
@@ -273,6 +533,7 @@ class User:
         self.daily_until: int = daily_until # timestamp after which the daily reward may be collected
         self.max_slots: int = max_slots # maximum amount of slots
         self.slots: List[Slot] = [Slot(**i) for i in slots]
+        self.notifications: List[int] = list(notifications) # minutes before lessons to notify the user at
 
     def to_dict(self) -> dict:
         return {
@@ -284,7 +545,8 @@ class User:
             "slots": [i.to_dict() for i in self.slots],
             "company_name": self.company_name,
             "company_handle": self.company_handle,
-            "handle_change_free": self.handle_change_free
+            "handle_change_free": self.handle_change_free,
+            "notifications": self.notifications
         }
         
     def update_name(self, full_name:str, handle:str) -> bool:
@@ -310,38 +572,261 @@ class User:
         
 
 
+class UserStore(MutableMapping):
+    def __init__(self, on_hydrate:Callable[[User], None]=None):
+        '''
+        A dict of users that keeps users loaded from the database
+        as raw records and turns them into `User` objects only
+        when they are accessed for the first time.
+        '''
+        self.raw: Dict[int, dict] = {} # stored users that weren't accessed yet
+        self.hydrated: Dict[int, User] = {} # users that were already accessed
+        self.on_hydrate: Callable[[User], None] = on_hydrate # called with every freshly built user
+
+    def __getitem__(self, id:int) -> User:
+        if id in self.hydrated:
+            return self.hydrated[id]
+
+        data = self.raw.pop(id)
+        user = User(id=id, **data)
+        # fields missing in the database stay dirty
+        # so their default values get written
+        user.clean(data.keys())
+
+        self.hydrated[id] = user
+        if self.on_hydrate:
+            self.on_hydrate(user)
+        return user
+
+    def __setitem__(self, id:int, user:User):
+        self.raw.pop(id, None)
+        self.hydrated[id] = user
+
+    def __delitem__(self, id:int):
+        if id in self.raw:
+            del self.raw[id]
+        else:
+            del self.hydrated[id]
+
+    def __contains__(self, id:int) -> bool:
+        return id in self.hydrated or id in self.raw
+
+    def __iter__(self) -> Iterator[int]:
+        yield from list(self.hydrated)
+        yield from list(self.raw)
+
+    def __len__(self) -> int:
+        return len(self.hydrated)+len(self.raw)
+
+    def peek(self, *fields:str) -> Iterator[Tuple[int, tuple]]:
+        '''
+        Yields user IDs with values of the given stored fields
+        without building `User` objects.
+
+        Fields missing in raw records are None.
+        '''
+        for id, user in list(self.hydrated.items()):
+            yield id, tuple(getattr(user, i) for i in fields)
+
+        for id, data in list(self.raw.items()):
+            yield id, tuple(data.get(i, None) for i in fields)
+
+
+# lesson data
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'] # weekday keys in the lesson file
+SHARED_LESSONS: MutableMapping[Tuple[str, str], Lesson] = weakref.WeakValueDictionary() # lessons of all managers by IDs and source JSON
+SHARED_DAYS: MutableMapping[Tuple[int, str], Day] = weakref.WeakValueDictionary() # days of all managers by weekdays and source JSON
+
+class LessonsDiff:
+    def __init__(self):
+        '''
+        Lists what changed in the lesson data after a reload.
+        '''
+        self.lessons: Set[str] = set() # IDs of added, removed and changed lessons
+        self.weekdays: Set[int] = set() # indexes of changed weekdays
+        self.dates: Set[datetime.date] = set() # dates with added, removed and changed substitutions
+
+    def __bool__(self) -> bool:
+        return bool(self.lessons or self.weekdays or self.dates)
+
+    def affects(self, day:Day) -> bool:
+        '''
+        Returns whether anything shown about the day
+        has changed.
+        '''
+        if day.weekday in self.weekdays:
+            return True
+        if day.substitution != None and day.substitution.date in self.dates:
+            return True
+
+        return any(
+            i.name in self.lessons or i.replaced in self.lessons for i in day.events
+        )
+
+
+class LessonData:
+    def __init__(self, raw:dict, old:"LessonData"=None):
+        '''
+        Lessons, schedule and substitutions loaded from the lesson file.
+
+        Lessons, days and substitutions that are the same as in `old`
+        are taken from it instead of being built again, and `diff`
+        lists everything else. Lessons and days that are the same
+        as in lesson files of other managers are shared with them.
+        '''
+        self.sources: Dict[Tuple[str, Any], str] = {} # JSON of the data every lesson, weekday and substitution was built from
+        self.diff: LessonsDiff = LessonsDiff() # changes since `old`
+        old_sources = old.sources if old else {}
+
+        def unchanged(key:Tuple[str, Any], data:Any) -> bool:
+            self.sources[key] = json.dumps(data, sort_keys=True)
+            return self.sources[key] == old_sources.get(key, None)
+
+        # lessons
+        self.lessons: Dict[str, Lesson] = {}
+        for id, data in raw['lessons'].items():
+            if unchanged(('lesson', id), data):
+                self.lessons[id] = old.lessons[id]
+                continue
+
+            key = (id, self.sources[('lesson', id)])
+            lesson = SHARED_LESSONS.get(key, None)
+            if lesson == None:
+                lesson = SHARED_LESSONS[key] = Lesson(id, data)
+
+            self.lessons[id] = lesson
+            self.diff.lessons.add(id)
+
+        if old:
+            self.diff.lessons.update(set(old.lessons)-set(self.lessons))
+
+        # schedule
+        schedule = raw['default_schedule'] # default schedule
+        self.start_time: List[int] = raw['default_start_time'] # 1st value is hours, 2nd is minutes
+
+        self.schedule: List[Day] = [] # this is the default schedule
+        for weekday, key in enumerate(WEEKDAYS):
+            i = raw.get(key, {"lessons": []})
+            lessons = i.get('lessons', [])
+            for lesson in lessons:
+                assert lesson in self.lessons, f"Unknown lesson {lesson} on {key}"
+
+            # getting starting time
+            # and yes i fucking HATE THIS SHIT IVE BEEN SITTING HERE FOR LIKE 5 HOURS MY HEAD FUCKING HURTS SO MUCH SMH
+            start_time_format = i.get('start_time', self.start_time)
+            day_schedule = i.get('schedule', schedule)
+
+            if unchanged(('weekday', weekday), [start_time_format, lessons, day_schedule]):
+                self.schedule.append(old.schedule[weekday])
+                continue
+
+            start_time = datetime.datetime.now() # we don't really care about the date
+                                                 # right now so we can just pass in anything
+            start_time = datetime.datetime(
+                start_time.year, start_time.month, start_time.day,
+                start_time_format[0],  start_time_format[1], 0, 0
+            )
+
+            key = (weekday, self.sources[('weekday', weekday)])
+            day = SHARED_DAYS.get(key, None)
+            if day == None:
+                day = SHARED_DAYS[key] = Day(start_time, lessons, day_schedule, weekday)
+
+            self.schedule.append(day)
+            self.diff.weekdays.add(weekday)
+
+        self.available_days: List[int] = [
+            index for index,i in enumerate(self.schedule) if len(i.lessons) > 0
+        ] # list of days with lessons
+        assert len(self.available_days) > 0, "No weekdays with lessons found in them"
+
+        # substitutions
+        self.substitutions: Dict[datetime.date, Substitution] = {} # substitutions by date
+
+        for date, data in raw.get('substitutions', {}).items():
+            date = datetime.date.fromisoformat(date)
+            if unchanged(('date', date), data) and date.weekday() not in self.diff.weekdays:
+                substitution = old.substitutions[date]
+            else:
+                substitution = Substitution(date, data)
+                self.diff.dates.add(date)
+
+            # checking reused substitutions too since
+            # their lessons might've been removed
+            day = self.schedule[date.weekday()]
+            lesson_events = len([i for i in day.events if not i.is_break])
+
+            for number, lesson in substitution.lessons.items():
+                assert 0 < number <= lesson_events, f"No lesson number {number} on {date}"
+                assert lesson == None or lesson in self.lessons, f"Unknown lesson {lesson} on {date}"
+
+            self.substitutions[date] = substitution
+
+        if old:
+            self.diff.dates.update(set(old.substitutions)-set(self.substitutions))
+
+
 # main manager
 
+SEARCH_FIELDS = ['company_handle', 'handle', 'full_name', 'company_name'] # user fields searched by, in order of priority
+FUZZY_SEARCH_FIELDS = ['full_name', 'handle', 'company_name'] # user fields searched by with typos allowed
+
+
 class Manager:
-    def __init__(self, lessons_file:str, db_file:str):
+    def __init__(self,
+        lessons_file:str, db_file:str, db_backend:str=config.DB_BACKEND,
+        backup_folder:str=config.BACKUP_FOLDER
+    ):
         '''
         Manages basically the entire bot.
         '''
         self.lessons_file = lessons_file # path to file with lesson data
+        self.lessons_generation: int = 0 # bumped every time lessons are loaded from scratch
+        self.homework_generation: int = 0 # bumped every time homework is added or removed
+        self.attachments_generation: int = 0 # bumped every time attachments are added or removed
         self.db_file = db_file # path to database file
+        self.storage: db.Backend = db.BACKENDS[db_backend](db_file) # database storage backend
+        self.scheduler = db.CommitScheduler(self.storage.write) # writes changes off the event loop
+        self.backups = backup.Backups(
+            self.storage, backup_folder, flush=self.scheduler.flush
+        ) # database backups
+        self.acl = acl.AccessControl() # user permissions
 
         self.states: Dict[int, str] = {} # list of user states
+        self.searches: Dict[int, str] = {} # last user search query of each user
+        self.user_fuzzy_task: asyncio.Task = None # task building the typo-tolerant search index
+        self.changes: Set[Tuple[str, Any]] = set() # entries changed since the last commit
+
+        self.transaction_depth: int = 0 # amount of nested transactions currently open
+        self.undo: List[Callable] = [] # functions that roll back the current transaction
+        self.after_commit: List[Callable] = [] # functions to call when the transaction succeeds
+        self.reindexed: List[Entry] = [] # entries reindexed in the current transaction
+        self.lessons_lock: asyncio.Lock = None # lock for reloading lessons
+        self.lesson_data: LessonData = None # data loaded from the lesson file
+        self.days: Dict[datetime.date, Day] = {} # resolved days by date
+        self.timeline: Timeline = None # compiled schedule for the next 7 days
+        self.timeline_date: datetime.date = None # date the timeline was compiled at
 
         self.reload_lessons()
         self.reload_db()
 
 
-    def clone_db(self):
+    def clone_db(self, wait:bool=False):
         '''
-        Copies the database into a backup file.
-        '''
-        with open(self.db_file, encoding='utf8') as f:
-            data = f.read()
+        Backs up the database in a background thread.
 
-        with open(f'{self.db_file}.bak', 'w', encoding='utf8') as f:
-            f.write(data)
+        If `wait` is True, returns only after the database
+        files were copied.
+        '''
+        self.backups.create(wait)
 
 
-    def commit_db(self):
+    def to_dict(self) -> dict:
         '''
-        Pushes all data to the database file.
+        Converts the entire database to a dictionary.
         '''
-        data = {
+        return {
             "users": {
                 i: self.users[i].to_dict() for i in self.users
             },
@@ -354,8 +839,387 @@ class Manager:
             "blacklist": self.blacklist,
             "write_blacklist": self.write_blacklist
         }
-        with open(self.db_file, 'w', encoding='utf8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+    def mark(self, collection:str, id:Any=None):
+        '''
+        Marks an entry in a collection as changed so it gets
+        written on the next commit.
+
+        If no ID is provided, marks the whole collection.
+        '''
+        self.changes.add((collection, id))
+
+
+    def track(self, entry:Entry):
+        '''
+        Starts tracking changes of an entry.
+        '''
+        entry.on_change = self.on_entry_change
+
+        # entries that are dirty from the start, like users built
+        # with missing fields, won't report their next change
+        if entry.dirty_fields:
+            self.on_entry_change(entry)
+
+
+    def on_entry_change(self, entry:Entry):
+        '''
+        Called right before a tracked entry gets changed.
+        '''
+        self.mark(entry.collection, entry.id)
+
+        if not self.transaction_depth:
+            return
+
+        # remembering the entry as it was before the transaction
+        state = {k: v for k, v in entry.__dict__.items() if k != 'dirty_fields'}
+        dirty = set(entry.dirty_fields)
+
+        def restore():
+            entry.__dict__.update(state)
+            entry.dirty_fields = dirty
+
+        self.undo.append(restore)
+
+
+    def put(self, entry:Entry):
+        '''
+        Adds an entry to its collection and starts tracking it.
+        '''
+        entries: dict = getattr(self, entry.collection)
+        old: Entry = entries.get(entry.id, None)
+
+        if old:
+            self.unindex(old)
+        entries[entry.id] = entry
+        self.index(entry)
+        self.track(entry)
+
+        if self.transaction_depth:
+            self.undo.append(
+                (lambda: self.put(old)) if old else
+                (lambda: self.drop(entry.collection, entry.id))
+            )
+
+
+    def drop(self, collection:str, id:Any) -> Entry:
+        '''
+        Removes an entry from its collection and returns it.
+
+        Returns None if there is no such entry.
+        '''
+        entry: Entry = getattr(self, collection).pop(id, None)
+        if entry == None:
+            return None
+
+        self.unindex(entry)
+        self.mark(collection, id)
+
+        if self.transaction_depth:
+            self.undo.append(lambda: self.put(entry))
+        return entry
+
+
+    def index(self, entry:Entry):
+        '''
+        Adds an entry to the lookup indexes.
+        '''
+        if isinstance(entry, HomeworkEntry):
+            self.homework_by_lesson.setdefault(entry.lesson, {})[entry.id] = entry
+            self.homework_generation += 1
+
+        elif isinstance(entry, Attachment):
+            self.attachments_by_lesson.setdefault(entry.lesson, {})[entry.id] = entry
+            self.attachments_generation += 1
+
+        elif isinstance(entry, User):
+            if entry.company_handle != None:
+                self.handles[entry.company_handle] = entry.id
+
+            for field, index in self.user_search.items():
+                value = getattr(entry, field)
+                if value:
+                    index.add(entry.id, value.casefold())
+
+            for i in entry.notifications:
+                self.subscribers.setdefault(i, set()).add(entry.id)
+
+            if self.user_fuzzy_search != None:
+                self.user_fuzzy_search.add(
+                    entry.id, *[getattr(entry, i) for i in FUZZY_SEARCH_FIELDS if getattr(entry, i)]
+                )
+            elif self.user_fuzzy_changes != None:
+                self.user_fuzzy_changes.add(entry.id)
+
+
+    def unindex(self, entry:Entry):
+        '''
+        Removes an entry from the lookup indexes.
+        '''
+        if isinstance(entry, HomeworkEntry):
+            entries = self.homework_by_lesson.get(entry.lesson, {})
+            entries.pop(entry.id, None)
+            if not entries:
+                self.homework_by_lesson.pop(entry.lesson, None)
+            self.homework_generation += 1
+
+        elif isinstance(entry, Attachment):
+            entries = self.attachments_by_lesson.get(entry.lesson, {})
+            entries.pop(entry.id, None)
+            if not entries:
+                self.attachments_by_lesson.pop(entry.lesson, None)
+            self.attachments_generation += 1
+
+        elif isinstance(entry, User):
+            if self.handles.get(entry.company_handle, None) == entry.id:
+                self.handles.pop(entry.company_handle)
+
+            for index in self.user_search.values():
+                index.remove(entry.id)
+            for i in entry.notifications:
+                self.subscribers.get(i, set()).discard(entry.id)
+            if self.user_fuzzy_search != None:
+                self.user_fuzzy_search.remove(entry.id)
+            elif self.user_fuzzy_changes != None:
+                self.user_fuzzy_changes.add(entry.id)
+
+
+    def reindex(self, entry:Entry):
+        '''
+        Updates the lookup indexes after indexed fields of an
+        entry were changed.
+        '''
+        self.unindex(entry)
+        self.index(entry)
+
+        # rolled back entries get reindexed again
+        if self.transaction_depth:
+            self.reindexed.append(entry)
+
+
+    def rebuild_indexes(self):
+        '''
+        Builds all lookup indexes from scratch.
+        '''
+        # everything rendered from the old entries is stale
+        # even if no entries are left to index
+        self.homework_generation += 1
+        self.attachments_generation += 1
+
+        self.homework_by_lesson: Dict[str, Dict[str, HomeworkEntry]] = {} # homework by lesson IDs, in insertion order
+        self.attachments_by_lesson: Dict[str, Dict[str, Attachment]] = {} # attachments by lesson IDs, in insertion order
+        self.handles: Dict[str, int] = {} # user IDs by company handles
+        self.user_search: Dict[str, search.PrefixIndex] = {
+            i: search.PrefixIndex() for i in SEARCH_FIELDS
+        } # user IDs by casefolded searchable fields
+        self.user_fuzzy_search: search.TrigramIndex = None # user IDs by names for typo-tolerant search, built in the background
+        self.user_fuzzy_changes: Set[int] = None # IDs of users changed while the typo-tolerant search index is built
+        self.subscribers: Dict[int, Set[int]] = {} # IDs of users to notify by minutes before lessons
+        self.acl.load(self.blacklist, self.write_blacklist)
+        self.synced_names: Dict[int, Tuple[str, str]] = {} # names of users as of their last sync
+
+        for i in self.homework.values():
+            self.index(i)
+        for i in self.attachments.values():
+            self.index(i)
+        # reading raw records so users don't get built
+        users = [
+            (id, dict(zip(SEARCH_FIELDS, values)))
+            for id, values in self.users.peek(*SEARCH_FIELDS)
+        ]
+
+        for id, values in users:
+            if values['company_handle'] != None:
+                self.handles[values['company_handle']] = id
+
+        for id, (notifications,) in self.users.peek('notifications'):
+            for i in notifications or []:
+                self.subscribers.setdefault(i, set()).add(id)
+
+        for field, index in self.user_search.items():
+            index.build(
+                (id, [values[field].casefold()] if values[field] else [])
+                for id, values in users
+            )
+
+
+    def on_user_hydrate(self, user:User):
+        '''
+        Called when a user gets built from a raw database record.
+        '''
+        # users stored without a handle get a generated one
+        # which might already be taken by someone else
+        if self.handles.get(user.company_handle, user.id) != user.id:
+            user.company_handle = self.unique_handle(user.full_name)
+
+        # fields missing in the record might've gotten default values
+        self.unindex(user)
+        self.index(user)
+        self.track(user)
+
+
+    def remember_list(self, collection:str):
+        '''
+        Makes a list collection get restored if the current
+        transaction fails. Should be called before changing it.
+        '''
+        if not self.transaction_depth:
+            return
+
+        data: list = getattr(self, collection)
+        old = list(data)
+
+        def restore():
+            data[:] = old
+            self.acl.load(self.blacklist, self.write_blacklist)
+
+        self.undo.append(restore)
+
+
+    def on_commit(self, function:Callable):
+        '''
+        Calls the function once the current transaction is
+        committed, or right away if there is no transaction.
+
+        Used for things that can't be rolled back, like
+        removing files.
+        '''
+        if self.transaction_depth:
+            self.after_commit.append(function)
+        else:
+            function()
+
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Groups all changes made inside into a single commit that
+        is made when the outermost transaction exits.
+
+        If an exception is raised inside, all in-memory changes
+        made since the outermost transaction started are rolled
+        back and nothing is committed.
+        '''
+        if self.transaction_depth == 0:
+            # making sure every entry is clean before it's remembered
+            self.commit_db()
+            self.undo = []
+            self.after_commit = []
+            self.reindexed = []
+
+        self.transaction_depth += 1
+        try:
+            yield
+        except:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.rollback()
+            raise
+
+        self.transaction_depth -= 1
+        if self.transaction_depth == 0:
+            actions = self.after_commit
+            self.undo = []
+            self.after_commit = []
+            self.reindexed = []
+
+            self.commit_db()
+            for i in actions:
+                i()
+
+
+    def rollback(self):
+        '''
+        Reverts all in-memory changes of the current transaction.
+        '''
+        log(f'Rolling back {len(self.undo)} changes', level=WARNING)
+
+        for i in reversed(self.undo):
+            i()
+
+        reindexed = self.reindexed
+        self.undo = []
+        self.after_commit = []
+        self.reindexed = []
+
+        # entries that were already dirty when they got into the
+        # transaction, like users built with missing fields, aren't
+        # restored to clean, so they still have to be written
+        changes = list(self.changes)
+        self.changes.clear()
+        for collection, id in changes:
+            entry = getattr(self, collection).get(id, None) if id != None else None
+            if entry != None and entry.dirty_fields:
+                self.mark(collection, id)
+        # rolled back users have to be synced again
+        self.synced_names.clear()
+
+        for i in reindexed:
+            if getattr(self, i.collection).get(i.id, None) is i:
+                self.reindex(i)
+
+
+    def commit_db(self):
+        '''
+        Schedules all changed entries to be written to the
+        database.
+
+        Only a snapshot of the changed entries is taken here,
+        encoding and writing happens on the scheduler's thread.
+
+        Does nothing inside a transaction.
+        '''
+        if self.transaction_depth:
+            return
+
+        records = []
+
+        for collection, id in self.changes:
+            data = getattr(self, collection)
+
+            # whole collection
+            if id == None:
+                records.append({"c": collection, "v": list(data)})
+                continue
+
+            # deleted entry
+            entry: Entry = data.get(id, None)
+            if entry == None:
+                records.append({"c": collection, "id": str(id), "v": None})
+                continue
+
+            # only changed fields of an entry
+            if not entry.dirty_fields:
+                continue
+            records.append({"c": collection, "id": str(id), "v": entry.dirty_dict()})
+            entry.clean()
+
+        self.changes.clear()
+        self.scheduler.submit(records)
+
+        # backing up only after the database changed,
+        # the backup writes the records before copying
+        if records and self.backups.due():
+            self.clone_db()
+
+
+    def flush(self):
+        '''
+        Synchronously writes all pending changes to the database.
+        '''
+        self.commit_db()
+        self.scheduler.flush()
+
+
+    def close(self):
+        '''
+        Writes all pending changes and stops writing to the
+        database. The manager can't be used after this.
+        '''
+        self.commit_db()
+        self.scheduler.stop()
+        self.storage.wait()
 
 
     def create_db(self):
@@ -366,102 +1230,173 @@ class Manager:
         self.attachments: Dict[str, Attachment] = {}
         self.blacklist: List[int] = []
         self.write_blacklist: List[int] = []
-        self.users: Dict[int, User] = {}
+        self.users: UserStore = UserStore(self.on_user_hydrate)
+        self.rebuild_indexes()
 
-        self.commit_db()
+        self.changes.clear()
+        self.storage.reset(self.to_dict())
 
 
     def reload_lessons(self):
         '''
-        Loads lesson data from the file.
+        Loads lesson data from the file from scratch.
+        '''
+        self.lesson_data = None
+        self.swap_lessons(self.load_lessons())
+        self.lessons_generation += 1
+
+
+    def load_lessons(self) -> LessonData:
+        '''
+        Reads and validates the lesson file, reusing everything
+        that didn't change since the last load.
+
+        Doesn't change the manager, so it's safe to call
+        from another thread.
         '''
         with open(self.lessons_file, encoding='utf8') as f:
             raw_lessons: dict = json.load(f)
 
-        # lessons
-        self.lessons: Dict[str, Lesson] = {
-            i: Lesson(i, raw_lessons['lessons'][i]) for i in raw_lessons['lessons']
+        return LessonData(raw_lessons, self.lesson_data)
+
+
+    def swap_lessons(self, data:LessonData) -> LessonsDiff:
+        '''
+        Replaces the lesson data all at once and forgets
+        resolved days that changed.
+        '''
+        diff = data.diff
+        self.lesson_data: LessonData = data # data loaded from the lesson file
+        self.lessons: Dict[str, Lesson] = data.lessons # lessons by IDs
+        self.schedule: List[Day] = data.schedule # this is the default schedule
+        self.start_time: List[int] = data.start_time # 1st value is hours, 2nd is minutes
+        self.available_days: List[int] = data.available_days # list of days with lessons
+        self.substitutions: Dict[datetime.date, Substitution] = data.substitutions # substitutions by date
+
+        self.days = {
+            date: day for date, day in self.days.items()
+            if date not in diff.dates and not diff.affects(day)
         }
+        self.timeline = None
+        self.timeline_date = None
 
-        # schedule
-        schedule = raw_lessons['default_schedule'] # default schedule
-        self.start_time: List[int] = raw_lessons['default_start_time'] # 1st value is hours, 2nd is minutes
-
-        default = {"lessons": []}
-        weekdays: List[dict] = [
-            raw_lessons.get('monday', default), 
-            raw_lessons.get('tuesday', default),
-            raw_lessons.get('wednesday', default),
-            raw_lessons.get('thursday', default),
-            raw_lessons.get('friday', default),
-            raw_lessons.get('saturday', default),
-            raw_lessons.get('sunday', default),
-        ]
+        return diff
 
-        self.schedule: List[Day] = [] # this is the default schedule
-        for i in weekdays:
-            # getting starting time
-            # and yes i fucking HATE THIS SHIT IVE BEEN SITTING HERE FOR LIKE 5 HOURS MY HEAD FUCKING HURTS SO MUCH SMH
-            start_time_format = i.get('start_time', self.start_time)
-            start_time = datetime.datetime.now() # we don't really care about the date
-                                                 # right now so we can just pass in anything
-            start_time = datetime.datetime(
-                start_time.year, start_time.month, start_time.day,
-                start_time_format[0],  start_time_format[1], 0, 0
-            )
 
-            self.schedule.append(Day(
-                start_time,
-                i.get('lessons', []),
-                i.get('schedule', schedule)
-            ))
+    async def areload_lessons(self) -> LessonsDiff:
+        '''
+        Reloads the lesson file without blocking the event loop
+        and returns what changed.
 
-        self.available_days: List[int] = [
-            index for index,i in enumerate(self.schedule) if len(i.lessons) > 0
-        ] # list of days with lessons
-        assert len(self.available_days) > 0, "No weekdays with lessons found in them"
+        Raises an exception and keeps the current lessons
+        if the file is invalid.
+        '''
+        if self.lessons_lock == None:
+            self.lessons_lock = asyncio.Lock()
 
-        # substitutions
-        # self.update_substitutions()
+        async with self.lessons_lock:
+            data = await asyncio.to_thread(self.load_lessons)
+            diff = self.swap_lessons(data)
+
+        if diff:
+            log(f'Reloaded lessons: {len(diff.lessons)} lessons, '\
+                f'{len(diff.weekdays)} weekdays and {len(diff.dates)} substitutions changed')
+        return diff
 
 
     def reload_db(self):
         '''
         Loads the database.
         '''
+        # writing pending changes so the database is up to date
+        self.flush()
+
         # checking if database exists
-        if not os.path.exists(self.db_file):
+        if not self.storage.exists():
             self.create_db()
             return
 
-        # reading the database
+        # reading the database row by row
+        homework: Dict[str, HomeworkEntry] = {}
+        attachments: Dict[str, Attachment] = {}
+        users: UserStore = UserStore(self.on_user_hydrate)
+        lists: Dict[str, List[int]] = {}
+
         try:
-            with open(self.db_file, encoding='utf8') as f:
-                raw_db: dict = json.load(f)
-        # creating the database
-        except:
-            self.clone_db()
+            for collection, id, data in self.storage.load():
+                if collection == 'homework':
+                    entry = homework[id] = HomeworkEntry(id=id, **data)
+                elif collection == 'attachments':
+                    entry = attachments[id] = Attachment(id=id, **data)
+                elif collection == 'users':
+                    # users are built only when they are needed
+                    users.raw[int(id)] = data
+                    continue
+                else:
+                    lists[collection] = data
+                    continue
+
+                # fields missing in the database stay dirty
+                # so their default values get written
+                entry.clean(data.keys())
+        # creating the database if it's broken, other errors,
+        # like snapshots this python can't read, are raised
+        except db.READ_ERRORS as e:
+            log(f'Can\'t read the database, creating a new one: {e}', level=ERROR)
+            self.clone_db(True)
             self.create_db()
             return
 
         # loading data
-        homework = raw_db.get('homework', {})
-        self.homework: Dict[str, HomeworkEntry] =\
-            {i: HomeworkEntry(id=i, **homework[i]) for i in homework}
-        
-        attachments = raw_db.get('attachments', {})
-        self.attachments: Dict[str, Attachment] =\
-            {i: Attachment(id=i, **attachments[i]) for i in attachments}
+        self.homework: Dict[str, HomeworkEntry] = homework
+        self.attachments: Dict[str, Attachment] = attachments
+        self.blacklist: List[int] = lists.get('blacklist', [])
+        self.write_blacklist: List[int] = lists.get('write_blacklist', [])
+        self.users: UserStore = users
+        self.rebuild_indexes()
+
+        self.changes.clear()
+        for i in [homework, attachments]:
+            for entry in i.values():
+                self.track(entry)
+        self.commit_db()
+
+        # folding the replayed journal into the database file
+        self.storage.compact()
         
-        self.blacklist: List[int] = raw_db.get('blacklist', [])
-        self.write_blacklist: List[int] = raw_db.get('write_blacklist', [])
 
-        users = raw_db.get('users', {})
-        self.users: Dict[int, User] =\
-            {int(i): User(id=i, **users[i]) for i in users}
+    def sync_user(self, user:AiogramUser) -> User:
+        '''
+        Creates the user if needed, updates their name and
+        economy slots and returns them.
+
+        Users whose name didn't change since the last sync
+        are returned right away.
+        '''
+        name = (user.full_name, user.username)
+        if self.synced_names.get(user.id, None) == name:
+            data = self.users[user.id]
+            if len(data.slots) >= data.max_slots:
+                return data
+
+        with self.transaction():
+            # checking user
+            if user.id not in self.users:
+                self.new_user(user)
+
+            data = self.users[user.id]
+            if data.update_name(user.full_name, user.username):
+                self.reindex(data)
+
+            # economy slots
+            if len(data.slots) < data.max_slots:
+                data.slots = data.slots+[
+                    Slot() for _ in range(data.max_slots-len(data.slots))
+                ]
+
+        self.synced_names[user.id] = name
+        return data
 
-        self.commit_db()
-        
 
     def check(self, user:AiogramUser, write_action:bool=False) -> str:
         '''
@@ -473,43 +1408,41 @@ class Manager:
         '''
         # resetting user state
         self.reset_state(user.id)
+        self.sync_user(user)
 
-        # checking user
-        if user.id not in self.users:
-            self.new_user(user)
+        # checking permissions
+        return self.acl.check(user.id, write_action)
+            
 
-        changed = self.users[user.id].update_name(user.full_name, user.username)
+    def update_acl(self, collection:str, ids:Iterable[int], add:bool) -> List[int]:
+        '''
+        Adds users to the blacklist or the write blacklist
+        (or whitelists if they're enabled) or removes them from it.
 
-        # economy slots
-        while len(self.users[user.id].slots) < self.users[user.id].max_slots:
-            self.users[user.id].slots.append(Slot())
-            changed = True
+        Returns IDs of users that were actually added or removed.
+        '''
+        data: List[int] = getattr(self, collection)
+        present = set(data)
+        ids = [i for i in dict.fromkeys(ids) if (i in present) != add]
+        if not ids:
+            return []
 
-        # commiting if needed
-        if changed:
-            self.commit_db()
-        
+        self.remember_list(collection)
+        if add:
+            data.extend(ids)
+        else:
+            removed = set(ids)
+            data[:] = [i for i in data if i not in removed]
 
-        # checking permissions
-        if user.id in config.ADMINS: return None # все равны но админы ровнее
+        if collection == 'blacklist':
+            self.acl.update(ids, read=add)
+        else:
+            self.acl.update(ids, write=add)
+
+        self.mark(collection)
+        self.commit_db()
+        return ids
 
-        # blacklist
-        if not config.USE_WHITELIST and user.id in self.blacklist:
-            return 'Пользователь в черном списке'
-        
-        # whitelist
-        if config.USE_WHITELIST and user.id not in self.blacklist:
-            return 'Пользователь не в белом списке'
-        
-        if write_action:
-            # write blacklist
-            if not config.USE_WRITE_WHITELIST and user.id in self.write_blacklist:
-                return 'Нет прав для записи - Пользователь в чёрном списке'
-            
-            # write blacklist
-            if config.USE_WRITE_WHITELIST and user.id not in self.write_blacklist:
-                return 'Нет прав для записи - Пользователь не в белом списке'
-            
 
     def add_to_blacklist(self, id:int) -> bool:
         '''
@@ -517,9 +1450,7 @@ class Manager:
 
         Returns a boolean whether adding was successful.
         '''
-        if id in self.blacklist: return False
-        self.blacklist.append(id)
-        return True
+        return self.update_acl('blacklist', [id], True) != []
         
 
     def remove_from_blacklist(self, id:int) -> bool:
@@ -528,9 +1459,7 @@ class Manager:
 
         Returns a boolean whether removing was successful.
         '''
-        if id not in self.blacklist: return False
-        self.blacklist.remove(id)
-        return True
+        return self.update_acl('blacklist', [id], False) != []
     
 
     def write_availability(self, id:int) -> bool:
@@ -538,13 +1467,7 @@ class Manager:
         Returns whether the user with the given ID can
         write to the DB (like writing homework etc.).
         '''
-        if id in config.ADMINS: return True
-
-        if not config.USE_WRITE_WHITELIST and id in self.write_blacklist\
-            or config.USE_WRITE_WHITELIST and id not in self.write_blacklist:
-                return False
-        
-        return True
+        return self.acl.can_write(id)
     
 
     def get_state(self, id:int) -> str:
@@ -575,6 +1498,15 @@ class Manager:
             self.states.pop(id)
 
 
+    def pop_state(self, id:int) -> str:
+        '''
+        Removes the state of the user and returns it.
+
+        If no state, returns None.
+        '''
+        return self.states.pop(id, None)
+
+
     def new_user(self, user:AiogramUser):
         '''
         Creates a new user.
@@ -582,7 +1514,10 @@ class Manager:
         if user.id in self.users:
             return
         
-        self.users[user.id] = User(user.id, user.full_name, user.username)
+        self.put(User(
+            user.id, user.full_name, user.username,
+            company_handle=self.unique_handle(user.full_name)
+        ))
         self.commit_db()
 
 
@@ -597,16 +1532,59 @@ class Manager:
         return self.users[id]
     
 
-    def get_schedule(self, weekday_index:int) -> Day:
+    def get_day(self, date:datetime.date) -> Day:
         '''
-        Returns a schedule data for the day.
+        Returns the schedule for a date with its substitution
+        applied. Days are resolved once per date.
         '''
-        assert weekday_index in self.available_days, "No such weekday available"
+        if date in self.days:
+            return self.days[date]
+
+        # forgetting days that have passed
+        today = datetime.date.today()
+        for i in [i for i in self.days if i < today]:
+            del self.days[i]
 
-        # todo substitutions
-        day = self.schedule[weekday_index]
-        day.weekday = datetime.datetime.now().weekday()
+        day = self.schedule[date.weekday()]
+        if date in self.substitutions:
+            day = DayOverlay(day, self.substitutions[date])
+
+        self.days[date] = day
         return day
+    
+
+    def get_date(self, weekday_index:int, start:datetime.date=None) -> datetime.date:
+        '''
+        Returns the closest date with this weekday, not
+        earlier than the start date (today by default).
+        '''
+        start = start if start != None else datetime.date.today()
+        return start+datetime.timedelta(days=(weekday_index-start.weekday())%7)
+    
+
+    def get_timeline(self) -> Timeline:
+        '''
+        Returns the timeline of the next 7 days, starting today,
+        with substitutions applied. It's compiled once a day.
+        '''
+        today = datetime.date.today()
+
+        if self.timeline_date != today:
+            self.timeline = Timeline([
+                self.get_day(self.get_date(i, today)) for i in range(7)
+            ])
+            self.timeline_date = today
+
+        return self.timeline
+    
+
+    def get_schedule(self, weekday_index:int) -> Day:
+        '''
+        Returns a schedule data for the closest day
+        with this weekday.
+        '''
+        assert weekday_index in self.available_days, "No such weekday available"
+        return self.get_day(self.get_date(weekday_index))
         
 
     def next_available_weekday(self, start_weekday:int) -> int:
@@ -626,31 +1604,26 @@ class Manager:
         return weekday
     
 
-    def get_summary(self) -> Day:
+    def get_summary(self) -> Tuple[Day, int]:
         '''
         Returns the schedule that is used in the /summary command
         and its weekday index.
         '''
         cur_time = datetime.datetime.now()
+        today = cur_time.date()
         weekday: int = cur_time.weekday()
 
-        if weekday not in self.available_days:
-            # just showing the next available day
-            weekday = self.next_available_weekday(weekday)
-            return self.get_schedule(weekday), weekday
-        
-        else:
-            day: Day = self.get_schedule(weekday)
-
-            if cur_time.hour > day.lesson_end_time.hour or\
-            (cur_time.hour == day.lesson_end_time.hour\
-            and cur_time.minute >= day.lesson_end_time.minute): 
-                # if the current day is available and the school time had already passed
-                weekday = self.next_available_weekday((weekday+1)%7)
-                return self.get_schedule(weekday), weekday
-            else:
-                # if the school is still in progress
+        if weekday in self.available_days:
+            day: Day = self.get_day(today)
+
+            # if the school is still in progress
+            if cur_time.time() < day.lesson_end_time.time():
                 return day, weekday
+            
+        # just showing the next available day
+        weekday = self.next_available_weekday((weekday+1)%7)
+        date = self.get_date(weekday, today+datetime.timedelta(days=1))
+        return self.get_day(date), weekday
         
 
     def occurences(self, lesson:str) -> List[Tuple[int,int]]:
@@ -680,10 +1653,10 @@ class Manager:
         Adds a homework entry and returns its ID.
         '''
         id = utils.rand_id()
-        self.homework[id] = HomeworkEntry(
+        self.put(HomeworkEntry(
             id, lesson, utils.check_text(text), attachment,
             time.time(), written_by
-        )
+        ))
         self.commit_db()
         return id
     
@@ -695,13 +1668,11 @@ class Manager:
         if id not in self.homework:
             return
         
-        attachment = self.homework[id].attachment
-        self.homework.pop(id)
-
-        if attachment:
-            self.delete_attachment(attachment)
+        with self.transaction():
+            attachment = self.drop('homework', id).attachment
 
-        self.commit_db()
+            if attachment:
+                self.delete_attachment(attachment)
     
 
     def add_attachment(self,
@@ -712,10 +1683,10 @@ class Manager:
         '''
         Adds an attachment.
         '''
-        self.attachments[id] = Attachment(
+        self.put(Attachment(
             id, filename, lesson, comment,
             written_at, written_by
-        )
+        ))
         self.commit_db()
 
 
@@ -726,10 +1697,14 @@ class Manager:
         if id not in self.attachments:
             return
         
-        attachment = self.attachments[id]
-        if os.path.exists(attachment.filename):
-            os.remove(attachment.filename)
-        self.attachments.pop(id)
+        attachment = self.drop('attachments', id)
+
+        # the file can't be restored so it's removed only after committing
+        def remove():
+            if os.path.exists(attachment.filename):
+                os.remove(attachment.filename)
+
+        self.on_commit(remove)
         self.commit_db()
     
 
@@ -751,7 +1726,7 @@ class Manager:
         '''
         Returns all homework written for a specific lesson.
         '''
-        return [i for i in self.homework.values() if i.lesson == lesson]
+        return list(self.homework_by_lesson.get(lesson, {}).values())
     
     
     def get_attachment(self, id:str) -> Attachment:
@@ -761,6 +1736,24 @@ class Manager:
         Returns None if there is no such attachment.
         '''
         return self.attachments[id] if id in self.attachments else None
+
+
+    def get_attachments(self, lesson:str) -> List[Attachment]:
+        '''
+        Returns all attachments for a specific lesson.
+        '''
+        return list(self.attachments_by_lesson.get(lesson, {}).values())
+
+
+    def get_day_attachments(self, day:Day) -> List[Attachment]:
+        '''
+        Returns all attachments for lessons in a day, in the
+        order these lessons go.
+        '''
+        return [
+            attachment for lesson in day.lesson_ids
+            for attachment in self.attachments_by_lesson.get(lesson, {}).values()
+        ]
     
 
     def get_writable_lessons(self) -> Lesson:
@@ -775,30 +1768,126 @@ class Manager:
         Returns whether the handle is not occupied on any user
         and can be set on anyone.
         '''
-        for i in self.users.values():
-            if i.company_handle == handle:
-                return False
-            
-        return True
+        return handle not in self.handles
+
+
+    def unique_handle(self, text:str) -> str:
+        '''
+        Generates a company handle from the text that is not
+        occupied on any user.
+        '''
+        handle = utils.to_handle(text)
+
+        while not self.handle_available(handle):
+            handle = "".join(random.choices(
+                config.HANDLE_ALLOWED_LETTERS, k=config.HANDLE_MAX_LENGTH
+            ))
+
+        return handle
     
 
-    def find_user(self, string:str) -> List[User]:
+    def find_user(self,
+        string:str, offset:int=0,
+        limit:int=config.SEARCH_PAGE_SIZE
+    ) -> Tuple[List[User], int]:
         '''
-        Finds users in the database by name, handle, company
-        handle or company name and returns a list of successful
-        matches.
+        Finds users in the database whose name, handle, company
+        handle or company name starts with the string.
+
+        Exact matches go first, then the rest in alphabetical
+        order. Returns up to `limit` users starting from `offset`
+        and the offset of the next page, or None if it's the last one.
         '''
+        string = string.strip().casefold()
+
+        def matches(priority:int, field:str) -> Iterator[tuple]:
+            query = string.lstrip('@') if field == 'handle' else string
+            for key, id in self.user_search[field].search(query):
+                yield key != query, key, priority, id
+
         out = []
-        for user in self.users.values():
-            if user.handle.lower().startswith(string.lstrip('@').lower()) or\
-                user.company_handle == string.upper() or\
-                user.full_name.lower().startswith(string.lower()) or\
-                user.company_name.lower().startswith(string.lower()):
-                    out.append(user)
+        seen = set()
+
+        for *_, id in heapq.merge(*[
+            matches(priority, field) for priority, field in enumerate(SEARCH_FIELDS)
+        ]):
+            if id in seen:
+                continue
+            seen.add(id)
+
+            if len(seen) > offset+limit:
+                return out, offset+limit
+            if len(seen) > offset:
+                out.append(self.users[id])
             
-        return out
+        return out, None
     
 
+    def start_user_fuzzy_search(self):
+        '''
+        Starts building the index for typo-tolerant search
+        in the background.
+        '''
+        if self.user_fuzzy_search == None and self.user_fuzzy_changes == None:
+            self.user_fuzzy_task = asyncio.create_task(self.build_user_fuzzy_search())
+
+
+    async def build_user_fuzzy_search(self):
+        '''
+        Builds the index for typo-tolerant search.
+
+        The index takes seconds to build for large databases, so
+        it's built in a worker thread from a copy of the records,
+        and users changed in the meantime are indexed again after.
+        '''
+        changes = self.user_fuzzy_changes = set()
+        records = [
+            (id, [i for i in values if i])
+            for id, values in self.users.peek(*FUZZY_SEARCH_FIELDS)
+        ]
+
+        started = time.perf_counter()
+        index = search.TrigramIndex()
+        await asyncio.to_thread(index.build, records)
+
+        # the database was reloaded while building
+        if self.user_fuzzy_changes is not changes:
+            return
+
+        for id in changes:
+            index.remove(id)
+            if id in self.users:
+                user = self.users[id]
+                index.add(id, *[getattr(user, i) for i in FUZZY_SEARCH_FIELDS if getattr(user, i)])
+
+        self.user_fuzzy_search = index
+        self.user_fuzzy_changes = None
+        log(f'Built typo-tolerant search index of {len(index)} users in {time.perf_counter()-started:.1f}s')
+
+
+    def find_user_fuzzy(self,
+        string:str, limit:int=config.FUZZY_SEARCH_LIMIT
+    ) -> List[Tuple[User, float]]:
+        '''
+        Finds users whose name, handle or company name is similar
+        to the string, allowing typos and transliteration.
+
+        Returns up to `limit` users with their similarity scores
+        from 0 to 1, best first, or None if the index is
+        still being built.
+        '''
+        if self.user_fuzzy_search == None:
+            self.start_user_fuzzy_search()
+            return None
+
+        return [
+            (self.users[id], score) for id, score in self.user_fuzzy_search.search(
+                string.lstrip('@'), limit, config.FUZZY_SEARCH_THRESHOLD,
+                config.FUZZY_SEARCH_MAX_POSTINGS
+            )
+        ]
+
+
     def add_balance(self, id:int, amount:int) -> int:
         '''
         Adds certain amount of money to a player's account.
@@ -844,20 +1933,34 @@ class Manager:
         '''
         Changes the user's company handle to the provided one.
         '''
-        user = self.users[id]
-        user.company_handle = handle
-        # taking money
-        if charge:
-            if not user.handle_change_free:
-                assert user.balance >= config.HANDLE_CHANGE_COST,\
-                    'Insufficient funds'
-                user.balance -= config.HANDLE_CHANGE_COST
-            else:
-                user.handle_change_free = False
-    
-        # updating db
-        self.users[id] = user
-        self.commit_db()
+        with self.transaction():
+            user = self.users[id]
+            old_handle = user.company_handle
+            assert self.handles.get(handle, id) == id,\
+                'Handle is already taken'
+
+            self.unindex(user)
+            user.company_handle = handle
+            self.reindex(user)
+
+            def restore():
+                self.unindex(user)
+                self.handles[old_handle] = id
+
+            self.undo.append(restore)
+
+            # taking money
+            if charge:
+                if not user.handle_change_free:
+                    assert user.balance >= config.HANDLE_CHANGE_COST,\
+                        'Insufficient funds'
+                    user.balance -= config.HANDLE_CHANGE_COST
+                else:
+                    user.handle_change_free = False
+        
+            # updating db
+            self.users[id] = user
+            self.commit_db()
     
     
     def change_comp_name(self, id:int, name:str):
@@ -866,6 +1969,23 @@ class Manager:
         '''
         user = self.users[id]
         user.company_name = name
+        self.reindex(user)
         self.users[id] = user
 
         self.commit_db()
+
+
+    def set_notifications(self, id:int, offsets:Iterable[int]):
+        '''
+        Changes the minutes before lessons the user
+        gets notified at.
+        '''
+        offsets = sorted(set(offsets))
+        assert all(i in config.NOTIFY_OFFSETS for i in offsets), 'No such notification time'
+
+        user = self.users[id]
+        self.unindex(user)
+        user.notifications = offsets
+        self.reindex(user)
+
+        self.commit_db()
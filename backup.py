@@ -0,0 +1,178 @@
+from typing import *
+
+import os
+import shutil
+import tarfile
+import datetime
+import threading
+import time
+import db
+from log import *
+
+
+# backups
+
+class Backups:
+    def __init__(self,
+        backend:db.Backend, folder:str=config.BACKUP_FOLDER,
+        keep:int=config.BACKUP_KEEP,
+        compress_after:int=config.BACKUP_COMPRESS_AFTER,
+        interval:float=config.BACKUP_INTERVAL,
+        flush:Callable[[], None]=None
+    ):
+        '''
+        Makes timestamped copies (generations) of the database
+        in a background thread.
+
+        Only `keep` latest generations are kept, generations older
+        than `compress_after` latest ones are packed into `.tar.gz`
+        archives. Set `compress_after` to None to never compress.
+
+        Automatic generations are made at most once in `interval`
+        seconds, counting from the latest generation on disk, so
+        loading the database many times doesn't push old ones out.
+
+        `flush` is called before copying to write changes that
+        are still waiting to get into the database files.
+        '''
+        self.backend: db.Backend = backend # database to back up
+        self.folder: str = folder # folder with all generations
+        self.keep: int = keep # amount of generations to keep
+        self.compress_after: int = compress_after # amount of latest generations left uncompressed
+        self.interval: float = interval # minimum seconds between automatic generations
+        self.flush: Callable[[], None] = flush # writes pending changes to the database
+        self.created_at: float = self.latest() # timestamp of the latest generation
+
+        self.lock = threading.Lock() # only one backup is made at a time
+        self.sweep()
+
+
+    def generations(self) -> List[str]:
+        '''
+        Returns names of all existing generations, oldest first.
+        '''
+        if not os.path.exists(self.folder):
+            return []
+
+        return sorted(i for i in os.listdir(self.folder) if not i.endswith('.tmp'))
+
+
+    def sweep(self):
+        '''
+        Deletes generations and archives that were left
+        half-made when the bot stopped.
+        '''
+        if not os.path.exists(self.folder):
+            return
+
+        for i in os.listdir(self.folder):
+            if not i.endswith('.tmp'):
+                continue
+
+            path = os.path.join(self.folder, i)
+            log(f'Deleting unfinished backup {path}', level=WARNING)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+    def latest(self) -> float:
+        '''
+        Returns the timestamp of the latest generation,
+        or 0 if there are none.
+        '''
+        for i in reversed(self.generations()):
+            try:
+                return datetime.datetime.strptime(i[:26], '%Y-%m-%d_%H-%M-%S-%f').timestamp()
+            except ValueError:
+                continue
+        return 0
+
+
+    def due(self) -> bool:
+        '''
+        Returns whether it's time for an automatic generation.
+        '''
+        return time.time()-self.created_at >= self.interval
+
+
+    def create(self, wait:bool=False) -> threading.Thread:
+        '''
+        Starts making a new generation in a background thread
+        and returns the thread.
+
+        If `wait` is True, also waits for the copy itself to
+        finish, but not for the retention cleanup.
+        '''
+        self.created_at = time.time()
+        copied = threading.Event()
+        thread = threading.Thread(target=self.run, args=(copied,), daemon=True)
+        thread.start()
+
+        if wait:
+            copied.wait()
+        return thread
+
+
+    def run(self, copied:threading.Event):
+        '''
+        Makes a new generation and cleans up the old ones.
+        '''
+        with self.lock:
+            name = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+            folder = os.path.join(self.folder, name)
+
+            try:
+                if self.flush:
+                    self.flush()
+
+                # copying into a temporary folder first so a half-made
+                # generation is never mistaken for a complete one
+                os.makedirs(f'{folder}.tmp')
+                self.backend.backup(f'{folder}.tmp')
+                os.replace(f'{folder}.tmp', folder)
+                log(f'Backed up the database to {folder}')
+
+            except Exception as e:
+                log(f'Error while backing up the database: {e}', level=ERROR)
+                shutil.rmtree(f'{folder}.tmp', ignore_errors=True)
+                return
+
+            finally:
+                copied.set()
+
+            try:
+                self.clean_up()
+            except Exception as e:
+                log(f'Error while cleaning up backups: {e}', level=ERROR)
+
+
+    def clean_up(self):
+        '''
+        Deletes generations past the retention limit and
+        compresses old ones.
+        '''
+        generations = self.generations()
+
+        # deleting
+        while len(generations) > self.keep:
+            path = os.path.join(self.folder, generations.pop(0))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+        # compressing
+        if self.compress_after == None:
+            return
+
+        for i in generations[:max(0, len(generations)-self.compress_after)]:
+            path = os.path.join(self.folder, i)
+            if not os.path.isdir(path):
+                continue
+
+            with tarfile.open(f'{path}.tar.gz.tmp', 'w:gz') as tar:
+                tar.add(path, arcname=i)
+            os.replace(f'{path}.tar.gz.tmp', f'{path}.tar.gz')
+            shutil.rmtree(path)
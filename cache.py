@@ -0,0 +1,124 @@
+from typing import *
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import weakref
+import db
+
+
+# render cache
+
+class RenderCache:
+    def __init__(self, generation:Callable[[], Hashable]):
+        '''
+        Keeps rendered messages and keyboards until the data
+        they were rendered from changes.
+
+        `generation` returns the current version of that data,
+        everything is dropped when it returns something new.
+        '''
+        self.generation: Callable[[], Hashable] = generation # returns the current data version
+        self.version: Hashable = None # data version of cached items
+        self.items: Dict[Hashable, Any] = {} # cached items by keys
+
+    def get(self, key:Hashable, build:Callable[[], Any]) -> Any:
+        '''
+        Returns a cached item, building and caching it first
+        if needed.
+        '''
+        version = self.generation()
+        if version != self.version:
+            self.items.clear()
+            self.version = version
+
+        if key not in self.items:
+            self.items[key] = build()
+        return self.items[key]
+
+    def discard(self, predicate:Callable[[Hashable], bool]):
+        '''
+        Drops cached items with keys the predicate
+        returns True for.
+        '''
+        for key in [i for i in self.items if predicate(i)]:
+            del self.items[key]
+
+
+# uploaded files
+
+class UploadCache:
+    def __init__(self, filename:str=None, size:int=1000):
+        '''
+        Remembers telegram file IDs of uploaded renders, so the same
+        render can be sent again without making and uploading it.
+
+        The least recently used IDs are forgotten after there's more
+        than `size` of them. IDs are kept in `filename` between
+        restarts if it's given.
+        '''
+        self.filename: str = filename # path to the file with file IDs
+        self.size: int = size # maximum amount of remembered file IDs
+        self.file_ids: collections.OrderedDict[str, str] = collections.OrderedDict() # file IDs by render keys, least recently used first
+        self.locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary() # locks of renders being made
+
+        if self.filename and os.path.exists(self.filename):
+            self.file_ids.update(db.read_snapshot(self.filename))
+
+    @staticmethod
+    def key(id:str, *inputs:Any) -> str:
+        '''
+        Returns a render key of an object ID and everything
+        the render is made from.
+        '''
+        digest = hashlib.sha1(json.dumps(inputs, ensure_ascii=False).encode()).hexdigest()
+        return f'{id}_{digest[:16]}'
+
+    def lock(self, key:str) -> asyncio.Lock:
+        '''
+        Returns a lock that makes concurrent requests for
+        the same render wait for a single upload.
+        '''
+        lock = self.locks.get(key, None)
+        if lock == None:
+            lock = self.locks[key] = asyncio.Lock()
+        return lock
+
+    def get(self, key:str) -> str:
+        '''
+        Returns the file ID of a render, or None if
+        it wasn't uploaded.
+        '''
+        if key not in self.file_ids:
+            return None
+
+        self.file_ids.move_to_end(key)
+        return self.file_ids[key]
+
+    def put(self, key:str, file_id:str):
+        '''
+        Remembers the file ID of an uploaded render.
+        '''
+        self.file_ids[key] = file_id
+        self.file_ids.move_to_end(key)
+
+        while len(self.file_ids) > self.size:
+            self.file_ids.popitem(last=False)
+        self.save()
+
+    def forget(self, key:str):
+        '''
+        Forgets the file ID of a render that
+        can't be sent anymore.
+        '''
+        if self.file_ids.pop(key, None) != None:
+            self.save()
+
+    def save(self):
+        '''
+        Writes file IDs to the file.
+        '''
+        if self.filename:
+            db.write_snapshot(self.filename, dict(self.file_ids))
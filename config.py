@@ -1,6 +1,33 @@
 LOG_FILE = 'log.txt'          # path to log file
 LESSONS_FILE = 'lessons.json' # path to the file with lesson information
+LESSONS_POLL_INTERVAL = 2     # how often to check the lesson file for changes, in seconds
 DB_FILE = 'data.json'         # path to database file
+TENANTS = {}                  # classes served by the bot, by class codes, with paths to their lesson
+                              # and database files, like {'9a': ['lessons_9a.json', 'data_9a.json']}.
+                              # if empty, a single class uses LESSONS_FILE and DB_FILE
+DEFAULT_TENANT = 'default'    # code of the single class used when TENANTS is empty
+TENANTS_FILE = 'tenants.json' # path to the file where chats remember their classes
+TENANT_IDLE_TIMEOUT = 30*60   # seconds after which an unused class is unloaded from memory
+DB_BACKEND = 'json'           # database storage backend, 'json' or 'sqlite'. sqlite keeps the database
+                              # next to DB_FILE with the .sqlite extension and imports the json one once
+DB_SNAPSHOT_FORMAT = 'json'   # snapshot format of the json backend, 'json' (readable)
+                              # or 'binary' (loads several times faster and takes less space)
+JOURNAL_COMPACT_AFTER = 1000  # amount of database journal records after which
+                              # the journal is folded into the database file
+BACKUP_FOLDER = 'backups/'    # folder where database backups are stored, every class
+                              # gets its own subfolder when there are several
+BACKUP_KEEP = 10              # amount of database backups to keep, older ones are deleted
+BACKUP_COMPRESS_AFTER = 2     # backups older than this many latest ones are compressed (None to never compress)
+BACKUP_INTERVAL = 6*60*60     # minimum seconds between automatic backups, which are only made after the database changes
+COMMIT_INTERVAL = 500         # maximum delay in milliseconds before changes are written to the database
+COMMIT_MAX_PENDING = 50       # amount of pending changes after which they are written right away
+
+RATE_LIMITS = {
+    'text': (1, 5),               # text commands and buttons: 1 per second, up to 5 at once
+    'image': (0.2, 2)             # image rendering: 1 per 5 seconds, up to 2 at once
+} # per-user limits of each handler class as (tokens per second, bucket size)
+RATE_LIMIT_MAX_BUCKETS = 10000 # amount of rate limit buckets after which full ones are forgotten
+MAX_CONCURRENT_UPDATES = 50   # amount of updates handled at once, updates above it are dropped
 
 GREETING_PHRASES = [
     'С Новым Годом!',
@@ -23,6 +50,8 @@ ADMINS = [1365781815] # list of telegram user IDs that are admins in this bot
                       # the default one is me remove this please
 
 IMAGE_WATERMARK_TEXT = 'https://github.com/moontr3/ywt-global' # watermark to put on uploaded attachments
+OVERLAY_CACHE_FILE = 'overlays.json' # path to the file where telegram file IDs of attachments with overlays are kept
+OVERLAY_CACHE_SIZE = 5000 # amount of those file IDs to keep, least recently viewed ones are forgotten
 
 HELP_TEXT = '''\
 <b>/help</b> - список команд
@@ -30,6 +59,8 @@ HELP_TEXT = '''\
 <b>/homework</b> - посмотреть или изменить записанное ДЗ
 <b>/subject</b> - посмотреть информацию о предмете
 <b>/schedule</b> - посмотреть расписание уроков на любой день
+<b>/notify</b> - настроить уведомления о начале уроков
+<b>/class</b> - выбрать класс
 <b>/eco</b> - открыть меню экономики
 <b>/search</b> - найти пользователя экономики
 ''' # text displayes in /help and /start commans
@@ -47,3 +78,12 @@ HANDLE_MAX_LENGTH = 4 # maximum length of a handle
 HANDLE_CHANGE_COST = 500 # how much it costs to change company handle
 
 COMP_NAME_MAX_LENGTH = 50
+
+SEARCH_PAGE_SIZE = 10 # amount of users shown on a single page of /search results
+FUZZY_SEARCH_LIMIT = 10 # maximum amount of users shown when nothing matched exactly in /search
+FUZZY_SEARCH_THRESHOLD = 0.4 # minimum similarity from 0 to 1 of a name to the query in typo-tolerant search
+FUZZY_SEARCH_MAX_POSTINGS = 1000 # trigrams in more names than this are skipped in typo-tolerant search once enough
+                                 # matches are found, lower is faster but may miss weaker matches (None for no limit)
+
+NOTIFY_OFFSETS = [5, 15] # minutes before lessons users can choose to get notified at
+NOTIFY_RATE = 25 # maximum amount of notifications sent per second, telegram allows about 30
@@ -0,0 +1,994 @@
+from typing import *
+
+import os
+import json
+import threading
+import time
+import sqlite3
+import marshal
+import struct
+import shutil
+import gc
+import platform
+from concurrent.futures import ThreadPoolExecutor
+from log import *
+
+
+COLLECTIONS = ['users', 'homework', 'attachments'] # collections of entries keyed by ID
+LISTS = ['blacklist', 'write_blacklist'] # collections stored as plain lists of user IDs
+
+SNAPSHOT_EXTENSIONS: Dict[str, str] = {
+    'json': '.json',
+    'binary': '.bin'
+} # snapshot formats and their file extensions
+SNAPSHOT_MAGIC = b'YWTDB' # first bytes of a binary snapshot
+SNAPSHOT_VERSION = 1 # binary snapshot format version
+SNAPSHOT_HEADER = struct.Struct('<BBQ') # format version, marshal version, payload length
+READ_ERRORS = (FileNotFoundError, ValueError, sqlite3.DatabaseError) # errors of reading a missing or broken database
+
+
+class SnapshotError(Exception):
+    '''
+    Raised when a binary snapshot can't be read by this version
+    of the bot or of Python, or is truncated. The database is
+    not recreated then, so the data can still be recovered.
+    '''
+
+
+# functions
+
+def apply_record(data:dict, record:dict):
+    '''
+    Applies a single journal record to the raw database dict.
+
+    Records with an `id` field update the given fields of (or delete,
+    if the value is None) a single entry in a collection, records
+    without it replace the whole collection.
+    '''
+    collection = record['c']
+
+    if 'id' not in record:
+        data[collection] = record['v']
+        return
+
+    entries: dict = data.setdefault(collection, {})
+    if record['v'] == None:
+        entries.pop(record['id'], None)
+    else:
+        entries.setdefault(record['id'], {}).update(record['v'])
+
+
+def merge_record(pending:Dict[Tuple[str, str], dict], record:dict):
+    '''
+    Merges a change record into a dict of pending records, so
+    that changes of the same entry end up in a single record.
+    '''
+    key = (record['c'], record.get('id', None))
+    old = pending.get(key, None)
+
+    if old == None or 'id' not in record or record['v'] == None or old['v'] == None:
+        pending[key] = record
+        return
+
+    pending[key] = {**old, "v": {**old['v'], **record['v']}}
+
+
+def read_records(filename:str) -> List[dict]:
+    '''
+    Reads all records from a journal file.
+
+    A torn record at the end of the file (the bot was killed mid-write)
+    is skipped.
+    '''
+    out = []
+    if not os.path.exists(filename):
+        return out
+
+    with open(filename, encoding='utf8') as f:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                out.append(json.loads(line))
+            except Exception:
+                log(f'Skipping broken record {index+1} in {filename}', level=WARNING)
+
+    return out
+
+
+def link_or_copy(source:str, target:str):
+    '''
+    Hardlinks a file that's never changed in place, or copies
+    it in chunks if linking isn't possible.
+    '''
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def encode_snapshot(data:dict, format:str='json') -> bytes:
+    '''
+    Encodes the raw database dict into a snapshot.
+
+    Binary snapshots are a header followed by a `marshal` payload,
+    which only supports plain data types, is several times faster
+    to load than JSON and takes a fraction of the space.
+    '''
+    if format == 'json':
+        return json.dumps(data, ensure_ascii=False, indent=4).encode('utf8')
+
+    assert format == 'binary', f'Unknown snapshot format {format}'
+    payload = marshal.dumps(data, 4)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, 4, len(payload))
+    return SNAPSHOT_MAGIC+header+payload
+
+
+def decode_snapshot(raw:bytes) -> dict:
+    '''
+    Decodes a snapshot of any format.
+    '''
+    # the collector keeps rescanning the freshly built objects
+    # while decoding and there are no cycles in there anyway
+    enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        if not raw.startswith(SNAPSHOT_MAGIC):
+            return json.loads(raw)
+
+        start = len(SNAPSHOT_MAGIC)+SNAPSHOT_HEADER.size
+        version, marshal_version, length = SNAPSHOT_HEADER.unpack_from(raw, len(SNAPSHOT_MAGIC))
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f'Unsupported snapshot version {version}')
+
+        # marshal is not meant for persistence and its format
+        # may change between python versions
+        if marshal_version > marshal.version:
+            raise SnapshotError(
+                f'Snapshot was written with marshal format {marshal_version}, but this python only'
+                f' reads up to {marshal.version}. Convert it to json with the python version'
+                f' that wrote it: python db.py convert <db file> json'
+            )
+        if len(raw)-start != length:
+            raise SnapshotError(f'Snapshot is truncated: {len(raw)-start} of {length} bytes')
+
+        try:
+            return marshal.loads(memoryview(raw)[start:])
+        except (ValueError, EOFError, TypeError) as e:
+            raise SnapshotError(
+                f'Snapshot can\'t be read by python {platform.python_version()}: {e}.'
+                f' Convert it to json with the python version that wrote it:'
+                f' python db.py convert <db file> json'
+            )
+
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def read_snapshot(filename:str) -> dict:
+    '''
+    Reads a snapshot file of any format.
+    '''
+    with open(filename, 'rb') as f:
+        return decode_snapshot(f.read())
+
+
+def write_snapshot(filename:str, data:dict, format:str='json'):
+    '''
+    Atomically replaces the database snapshot with the given data.
+    '''
+    with open(f'{filename}.tmp', 'wb') as f:
+        f.write(encode_snapshot(data, format))
+    os.replace(f'{filename}.tmp', filename)
+
+
+# backends
+
+class Backend:
+    def __init__(self, filename:str):
+        '''
+        Base class for database storage backends.
+
+        The manager keeps all data in memory and only talks to
+        the backend to load it, to write change records and to
+        back it up.
+        '''
+        self.filename: str = filename # path to the database file
+
+
+    def exists(self) -> bool:
+        '''
+        Returns whether the database exists.
+        '''
+        return os.path.exists(self.filename)
+
+
+    def load(self) -> Iterator[Tuple[str, str, Any]]:
+        '''
+        Streams the database as `(collection, id, data)` tuples.
+
+        List collections are yielded whole with the ID being None.
+        '''
+        raise NotImplementedError
+
+
+    def reset(self, data:dict):
+        '''
+        Replaces the whole database with the given data.
+        '''
+        raise NotImplementedError
+
+
+    def write(self, records:List[dict]):
+        '''
+        Persists a batch of change records.
+        '''
+        raise NotImplementedError
+
+
+    def backup(self, folder:str):
+        '''
+        Copies the database files into the given folder.
+
+        Called from a background thread, so it must not load
+        the whole database into memory.
+        '''
+        raise NotImplementedError
+
+
+    def compact(self):
+        '''
+        Performs housekeeping after the database was loaded or
+        a lot of records were written.
+        '''
+        pass
+
+
+    def wait(self):
+        '''
+        Waits for background housekeeping to finish.
+        '''
+        pass
+
+
+# json files with journals
+
+class Shard:
+    def __init__(self,
+        filename:str, format:str='json',
+        compact_after:int=config.JOURNAL_COMPACT_AFTER
+    ):
+        '''
+        A snapshot with an append-only JSON log of per-entry
+        changes written on top of it.
+
+        The journal is folded into a fresh snapshot in a background
+        thread once it grows past `compact_after` records.
+        '''
+        self.snapshot_file: str = filename # path to the snapshot
+        self.format: str = format # format new snapshots are written in
+        self.journal_file: str = f'{filename}.journal' # path to the journal being written to
+        self.compacting_file: str = f'{filename}.journal.compacting' # path to the journal being folded
+        self.compact_after: int = compact_after # amount of records after which the journal is folded
+        self.records: int = 0 # amount of records in the current journal
+
+        self.lock = threading.Lock() # guards appending and journal rotation
+        self.compactor: threading.Thread = None # thread currently folding the journal
+
+
+    @property
+    def dirty(self) -> bool:
+        '''
+        Whether the journal has records that are not in the snapshot yet.
+        '''
+        return self.records > 0 or os.path.exists(self.compacting_file)
+
+
+    def exists(self) -> bool:
+        '''
+        Returns whether the snapshot exists.
+        '''
+        return os.path.exists(self.snapshot_file)
+
+
+    def load(self) -> dict:
+        '''
+        Reads the snapshot and replays the journal on top of it.
+        '''
+        self.wait()
+
+        data = {}
+        if self.exists():
+            data = read_snapshot(self.snapshot_file)
+
+        # a journal left over by an interrupted compaction goes first
+        # since all of its records are older than the current journal
+        for i in read_records(self.compacting_file):
+            apply_record(data, i)
+
+        records = read_records(self.journal_file)
+        for i in records:
+            apply_record(data, i)
+        self.records = len(records)
+
+        return data
+
+
+    def reset(self, data:dict):
+        '''
+        Writes a fresh snapshot and empties the journal.
+        '''
+        self.wait()
+
+        with self.lock:
+            write_snapshot(self.snapshot_file, data, self.format)
+
+            for i in [self.journal_file, self.compacting_file]:
+                if os.path.exists(i):
+                    os.remove(i)
+            self.records = 0
+
+
+    def write(self, records:List[dict]):
+        '''
+        Appends change records to the journal.
+        '''
+        if not records:
+            return
+
+        data = ''.join(
+            json.dumps(i, ensure_ascii=False, separators=(',',':'))+'\n'
+            for i in records
+        )
+
+        with self.lock:
+            with open(self.journal_file, 'a', encoding='utf8') as f:
+                f.write(data)
+            self.records += len(records)
+
+        if self.records >= self.compact_after:
+            self.compact()
+
+
+    def backup(self, folder:str):
+        '''
+        Copies the shard files into the given folder.
+
+        Snapshots are never changed in place, so they are hardlinked
+        when possible, journals are copied in chunks.
+        '''
+        # journals can't be rotated and snapshots can't be replaced
+        # while copying, otherwise the copy might miss some records
+        with self.lock:
+            self.wait()
+
+            for i in [self.snapshot_file, self.compacting_file, self.journal_file]:
+                if not os.path.exists(i):
+                    continue
+
+                target = os.path.join(folder, os.path.basename(i))
+                if i == self.snapshot_file:
+                    link_or_copy(i, target)
+                else:
+                    shutil.copyfile(i, target)
+
+
+    def retire(self):
+        '''
+        Renames all files of the shard so they are not loaded
+        anymore, but can still be recovered.
+        '''
+        self.wait()
+
+        for i in [self.snapshot_file, self.journal_file, self.compacting_file]:
+            if os.path.exists(i):
+                os.replace(i, f'{i}.old')
+
+
+    def compact(self):
+        '''
+        Folds the journal into a fresh snapshot in a background thread.
+        '''
+        # checking and starting under the lock, so two threads
+        # can't both see no compactor and start their own
+        with self.lock:
+            if self.compactor and self.compactor.is_alive():
+                return
+            if not self.dirty:
+                return
+
+            # new records go to a fresh journal while the old one is folded
+            if os.path.exists(self.journal_file):
+                if os.path.exists(self.compacting_file):
+                    # previous compaction never finished, merging journals
+                    with open(self.journal_file, encoding='utf8') as f:
+                        data = f.read()
+                    with open(self.compacting_file, 'a', encoding='utf8') as f:
+                        f.write(data)
+                    os.remove(self.journal_file)
+                else:
+                    os.replace(self.journal_file, self.compacting_file)
+            self.records = 0
+
+            self.compactor = threading.Thread(target=self.fold, daemon=True)
+            self.compactor.start()
+
+
+    def fold(self):
+        '''
+        Applies the rotated journal to the snapshot on disk.
+        '''
+        try:
+            data = {}
+            if self.exists():
+                data = read_snapshot(self.snapshot_file)
+
+            records = read_records(self.compacting_file)
+            for i in records:
+                apply_record(data, i)
+
+            write_snapshot(self.snapshot_file, data, self.format)
+            os.remove(self.compacting_file)
+            log(f'Folded {len(records)} journal records into {self.snapshot_file}')
+
+        except Exception as e:
+            log(f'Error while compacting journal: {e}', level=ERROR)
+
+
+    def wait(self):
+        '''
+        Waits for the running compaction to finish.
+        '''
+        if self.compactor:
+            self.compactor.join()
+
+
+SHARDS: Dict[str, List[str]] = {
+    'users': ['users'],
+    'homework': ['homework'],
+    'attachments': ['attachments'],
+    'acl': LISTS
+} # json backend shard names and the collections stored in them
+
+
+class JSONBackend(Backend):
+    def __init__(self, filename:str, snapshot_format:str=config.DB_SNAPSHOT_FORMAT):
+        '''
+        Keeps every group of collections in its own journaled
+        snapshot file, so a change only ever touches its own shard.
+
+        Shard paths are derived from the database path and the
+        snapshot format, e.g. `data.json` becomes `data.users.json`,
+        `data.acl.json`, etc. or `data.users.bin` for binary snapshots.
+        '''
+        super().__init__(filename)
+        self.snapshot_format: str = snapshot_format # format snapshots are written in
+
+        self.shards: Dict[str, Shard] = self.make_shards(snapshot_format) # shards by their names
+        self.shard_of: Dict[str, Shard] = {
+            collection: self.shards[i] for i in SHARDS for collection in SHARDS[i]
+        } # shards by the collections stored in them
+        self.legacy = Shard(filename, snapshot_format) # single-file database from older versions
+
+
+    def make_shards(self, format:str) -> Dict[str, Shard]:
+        '''
+        Returns shards of this database in the given snapshot format.
+        '''
+        name = os.path.splitext(self.filename)[0]
+        extension = SNAPSHOT_EXTENSIONS[format]
+        return {i: Shard(f'{name}.{i}{extension}', format) for i in SHARDS}
+
+
+    def find_old_shards(self) -> List[Shard]:
+        '''
+        Returns shards written in another snapshot format or
+        the old single-file database, whichever exists.
+        '''
+        for format in SNAPSHOT_EXTENSIONS:
+            if format == self.snapshot_format:
+                continue
+
+            shards = list(self.make_shards(format).values())
+            if any(i.exists() for i in shards):
+                return shards
+
+        return [self.legacy] if self.legacy.exists() else []
+
+
+    def exists(self) -> bool:
+        '''
+        Returns whether the database exists in any format.
+        '''
+        return any(i.exists() for i in self.shards.values())\
+            or len(self.find_old_shards()) > 0
+
+
+    def load(self) -> Iterator[Tuple[str, str, Any]]:
+        '''
+        Loads all shards in parallel and streams the result.
+        '''
+        # converting the database written in another format
+        # or the old single-file database to current shards
+        if not any(i.exists() for i in self.shards.values()):
+            old = self.find_old_shards()
+            log(f'Converting {", ".join(i.snapshot_file for i in old)} to {self.snapshot_format} shards')
+
+            data = {}
+            for i in old:
+                data.update(i.load())
+            self.reset(data)
+
+            for i in old:
+                i.retire()
+
+        with ThreadPoolExecutor(len(self.shards)) as pool:
+            data = dict(zip(
+                self.shards.keys(),
+                pool.map(Shard.load, self.shards.values())
+            ))
+
+        for shard, collections in SHARDS.items():
+            for collection in collections:
+                entries = data[shard].get(collection, [] if collection in LISTS else {})
+
+                if collection in LISTS:
+                    yield collection, None, entries
+                    continue
+
+                for id in entries:
+                    yield collection, id, entries[id]
+
+
+    def reset(self, data:dict):
+        '''
+        Writes fresh snapshots for every shard.
+        '''
+        for shard, collections in SHARDS.items():
+            self.shards[shard].reset({
+                i: data.get(i, [] if i in LISTS else {}) for i in collections
+            })
+
+
+    def write(self, records:List[dict]):
+        '''
+        Appends change records to the journals of their shards.
+        '''
+        batches: Dict[Shard, List[dict]] = {}
+        for i in records:
+            batches.setdefault(self.shard_of[i['c']], []).append(i)
+
+        for shard, batch in batches.items():
+            shard.write(batch)
+
+
+    def backup(self, folder:str):
+        '''
+        Copies every shard into the given folder.
+        '''
+        for i in self.shards.values():
+            i.backup(folder)
+
+
+    def compact(self):
+        '''
+        Folds journals of the shards that were changed.
+        '''
+        for i in self.shards.values():
+            if i.dirty:
+                i.compact()
+
+
+    def wait(self):
+        '''
+        Waits for all shards to finish compacting.
+        '''
+        for i in self.shards.values():
+            i.wait()
+
+
+# sqlite
+
+class SQLiteBackend(Backend):
+    def __init__(self, filename:str):
+        '''
+        Keeps the database in an SQLite file in WAL mode with
+        one row per entry, so a change only touches its own row.
+
+        The file path is derived from the database path, e.g.
+        `data.json` becomes `data.sqlite`. If it doesn't exist yet,
+        the json backend database at the same path is imported.
+        '''
+        super().__init__(f'{os.path.splitext(filename)[0]}.sqlite')
+        self.source: str = filename # path to the json backend database to import
+        self.lock = threading.Lock() # the connection is shared with the commit thread
+        self.conn: sqlite3.Connection = None
+
+
+    def exists(self) -> bool:
+        '''
+        Returns whether the database or a json backend
+        database to import exists.
+        '''
+        return super().exists() or JSONBackend(self.source).exists()
+
+
+    def create_tables(self, conn:sqlite3.Connection):
+        '''
+        Creates the tables if they don't exist.
+        '''
+        with conn:
+            for i in COLLECTIONS:
+                conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {i} (id TEXT PRIMARY KEY, data TEXT NOT NULL)'
+                )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS lists (name TEXT NOT NULL, value INTEGER NOT NULL)'
+            )
+
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Opens the database and creates the tables if needed.
+        '''
+        if self.conn:
+            return self.conn
+
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_tables(self.conn)
+        return self.conn
+
+
+    def import_json(self):
+        '''
+        Copies the json backend database into a new SQLite file.
+        '''
+        source = JSONBackend(self.source)
+        log(f'Importing {self.source} into {self.filename}')
+
+        data = {i: {} for i in COLLECTIONS}
+        for collection, id, value in source.load():
+            if id == None:
+                data[collection] = value
+            else:
+                data[collection][id] = value
+        source.wait()
+
+        self.reset(data)
+
+
+    def load(self) -> Iterator[Tuple[str, str, Any]]:
+        '''
+        Streams rows from the database.
+        '''
+        if not super().exists():
+            self.import_json()
+        conn = self.connect()
+
+        for collection in COLLECTIONS:
+            for id, data in conn.execute(f'SELECT id, data FROM {collection}'):
+                yield collection, id, json.loads(data)
+
+        for collection in LISTS:
+            yield collection, None, [
+                i[0] for i in conn.execute(
+                    'SELECT value FROM lists WHERE name = ? ORDER BY rowid', (collection,)
+                )
+            ]
+
+
+    def apply(self, conn:sqlite3.Connection, record:dict):
+        '''
+        Applies a single change record to the database.
+        '''
+        collection = record['c']
+
+        # whole list
+        if 'id' not in record:
+            assert collection in LISTS, f'Unknown list {collection}'
+            conn.execute('DELETE FROM lists WHERE name = ?', (collection,))
+            conn.executemany(
+                'INSERT INTO lists (name, value) VALUES (?, ?)',
+                [(collection, i) for i in record['v']]
+            )
+            return
+
+        # single entry
+        assert collection in COLLECTIONS, f'Unknown collection {collection}'
+        if record['v'] == None:
+            conn.execute(f'DELETE FROM {collection} WHERE id = ?', (record['id'],))
+            return
+
+        row = conn.execute(
+            f'SELECT data FROM {collection} WHERE id = ?', (record['id'],)
+        ).fetchone()
+        data = json.loads(row[0]) if row else {}
+        data.update(record['v'])
+
+        conn.execute(
+            f'INSERT OR REPLACE INTO {collection} (id, data) VALUES (?, ?)',
+            (record['id'], json.dumps(data, ensure_ascii=False))
+        )
+
+
+    def write(self, records:List[dict]):
+        '''
+        Writes a batch of change records in a single transaction.
+        '''
+        if not records:
+            return
+
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                for i in records:
+                    self.apply(conn, i)
+
+
+    def reset(self, data:dict):
+        '''
+        Replaces the whole database with the given data.
+
+        The new file is filled under a temporary name, so an
+        interrupted reset leaves the old one as it was. This
+        also replaces files that aren't SQLite databases at all.
+        '''
+        records = [
+            {"c": collection, "id": str(id), "v": value}
+            for collection in COLLECTIONS
+            for id, value in data.get(collection, {}).items()
+        ]
+        records.extend([
+            {"c": collection, "v": data.get(collection, [])} for collection in LISTS
+        ])
+
+        temp = f'{self.filename}.tmp'
+        if os.path.exists(temp):
+            os.remove(temp)
+
+        conn = sqlite3.connect(temp)
+        try:
+            self.create_tables(conn)
+            with conn:
+                for i in records:
+                    self.apply(conn, i)
+        finally:
+            conn.close()
+
+        with self.lock:
+            # closing the last connection folds the WAL back
+            # into the old file, leftovers belong to it anyway
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            for i in ['-wal', '-shm']:
+                if os.path.exists(f'{self.filename}{i}'):
+                    os.remove(f'{self.filename}{i}')
+
+            os.replace(temp, self.filename)
+
+
+    def backup(self, folder:str):
+        '''
+        Copies the database into the given folder page by page
+        using the SQLite online backup API.
+
+        Uses its own connection so writes can go on meanwhile.
+        '''
+        source = sqlite3.connect(self.filename)
+        target = sqlite3.connect(os.path.join(folder, os.path.basename(self.filename)))
+
+        try:
+            source.backup(target, pages=1024)
+        finally:
+            target.close()
+            source.close()
+
+
+    def compact(self):
+        '''
+        Moves the WAL contents into the main database file.
+        '''
+        with self.lock:
+            self.connect().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+BACKENDS: Dict[str, Type[Backend]] = {
+    'json': JSONBackend,
+    'sqlite': SQLiteBackend
+} # available storage backends by their config names
+
+
+# commit scheduler
+
+class CommitScheduler:
+    def __init__(self,
+        write:Callable[[List[dict]], None],
+        interval:int=config.COMMIT_INTERVAL,
+        max_pending:int=config.COMMIT_MAX_PENDING
+    ):
+        '''
+        Collects change records and writes them in batches on
+        a worker thread, at most every `interval` milliseconds
+        or as soon as `max_pending` mutations are waiting.
+
+        Records are snapshots of the changed entries taken by
+        the caller, so the worker never touches live objects.
+        '''
+        self.write: Callable[[List[dict]], None] = write # function that persists a batch of records
+        self.interval: float = interval/1000 # seconds between flushes
+        self.max_pending: int = max_pending # mutations after which a flush is forced
+
+        self.pending: Dict[Tuple[str, str], dict] = {} # records waiting to be written
+        self.mutations: int = 0 # amount of submits since the last flush
+        self.deadline: float = None # time when the pending records should be written
+        self.running: bool = True
+
+        self.cond = threading.Condition() # guards the pending records
+        self.write_lock = threading.Lock() # keeps batches in order
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+
+    def submit(self, records:List[dict]):
+        '''
+        Schedules records to be written.
+
+        Newer records for the same entry are merged into older ones.
+        '''
+        if not records:
+            return
+
+        with self.cond:
+            for i in records:
+                merge_record(self.pending, i)
+
+            self.mutations += 1
+            if self.deadline == None:
+                self.deadline = time.monotonic()+self.interval
+            if self.mutations >= self.max_pending:
+                self.deadline = time.monotonic()
+
+            self.cond.notify()
+
+
+    def take(self) -> List[dict]:
+        '''
+        Takes all pending records. Must be called with the condition held.
+        '''
+        batch = list(self.pending.values())
+        self.pending = {}
+        self.mutations = 0
+        self.deadline = None
+        return batch
+
+
+    def commit(self, batch:List[dict]):
+        '''
+        Writes a batch, putting it back in the queue on failure.
+        '''
+        try:
+            self.write(batch)
+        except Exception as e:
+            log(f'Error while writing to the database: {e}', level=ERROR)
+
+            with self.cond:
+                pending = {}
+                for i in batch+list(self.pending.values()):
+                    merge_record(pending, i)
+                self.pending = pending
+                if self.deadline == None:
+                    self.deadline = time.monotonic()+self.interval
+
+
+    def work(self):
+        '''
+        Worker thread loop.
+        '''
+        while self.running:
+            with self.cond:
+                while self.running and (
+                    self.deadline == None or self.deadline > time.monotonic()
+                ):
+                    timeout = None if self.deadline == None\
+                        else self.deadline-time.monotonic()
+                    self.cond.wait(timeout)
+
+            with self.write_lock:
+                with self.cond:
+                    batch = self.take()
+                if batch:
+                    self.commit(batch)
+
+
+    def flush(self):
+        '''
+        Synchronously writes all pending records.
+        '''
+        with self.write_lock:
+            with self.cond:
+                batch = self.take()
+            if batch:
+                self.commit(batch)
+
+
+    def stop(self):
+        '''
+        Writes all pending records and stops the worker thread.
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+        self.worker.join()
+        self.flush()
+
+
+# command line tools
+
+def convert(filename:str, format:str):
+    '''
+    Converts the json backend database to the given snapshot format.
+    '''
+    backend = JSONBackend(filename, format)
+    assert backend.exists(), f'No database found at {filename}'
+
+    for _ in backend.load():
+        pass
+    backend.wait()
+
+
+def benchmark(users:int=10000):
+    '''
+    Compares encoding and loading of snapshots in all formats
+    on a generated database.
+    '''
+    data = {
+        "users": {
+            str(i): {
+                "full_name": f'Пользователь {i}', "handle": f'user{i}',
+                "balance": i, "daily_until": time.time(), "max_slots": 5,
+                "slots": [{"toilet_data": None, "stamina_restored_at": 0} for _ in range(5)],
+                "company_name": f'Компания {i}', "company_handle": f'C{i%1000}',
+                "handle_change_free": True
+            } for i in range(users)
+        },
+        "homework": {
+            str(i): {
+                "lesson": "math", "text": f'Упражнение {i}', "attachment": None,
+                "written_at": time.time(), "written_by": i
+            } for i in range(users//10)
+        }
+    }
+
+    for format in SNAPSHOT_EXTENSIONS:
+        start = time.perf_counter()
+        raw = encode_snapshot(data, format)
+        encoded = time.perf_counter()
+        decode_snapshot(raw)
+        decoded = time.perf_counter()
+
+        print(
+            f'{format:<8} {len(raw)/1024/1024:>8.2f} MB  '
+            f'encode {(encoded-start)*1000:>8.1f} ms  '
+            f'load {(decoded-encoded)*1000:>8.1f} ms'
+        )
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        convert(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) in [2, 3] and sys.argv[1] == 'bench':
+        benchmark(*[int(i) for i in sys.argv[2:]])
+    else:
+        print(
+            'Usage:\n'
+            '  python db.py convert <db file> <json|binary>\n'
+            '  python db.py bench [users]'
+        )
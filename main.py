@@ -4,7 +4,8 @@
 from typing import *
 
 from aiogram import types, Dispatcher, Bot, F, client
-from aiogram.filters.command import Command
+from aiogram.filters.command import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 import asyncio
 
@@ -14,6 +15,11 @@ from dotenv import load_dotenv
 import time
 import utils
 import api
+import middlewares
+import cache
+import notifications
+import watcher
+import tenants
 import random
 from log import *
 
@@ -31,9 +37,36 @@ bot = Bot(TOKEN,
 )
 dp = Dispatcher()
 
-mg = api.Manager(
-    config.LESSONS_FILE, config.DB_FILE
-)
+registry = tenants.Tenants() # all classes served by the bot
+mg: api.Manager = tenants.TenantLocal(lambda tenant: tenant.manager) # manager of the class the update came from
+
+lesson_renders = tenants.TenantLocal(lambda tenant: cache.RenderCache(
+    lambda: tenant.manager.lessons_generation
+)) # messages and keyboards made only from lessons.json
+summary_renders = tenants.TenantLocal(lambda tenant: cache.RenderCache(lambda: (
+    tenant.manager.lessons_generation,
+    tenant.manager.homework_generation,
+    tenant.manager.attachments_generation
+))) # /summary bodies and keyboards
+
+# shared by all classes
+regular_font = ImageFont.truetype('assets/regular.ttf', 16)
+bold_font = ImageFont.truetype('assets/bold.ttf', 16)
+shadow_image = Image.open('assets/image_shadow.png').convert('RGBA')
+overlays = cache.UploadCache(
+    config.OVERLAY_CACHE_FILE, config.OVERLAY_CACHE_SIZE
+) # telegram file IDs of attachments with overlays
+
+throttling = middlewares.ThrottlingMiddleware()
+
+dp.update.outer_middleware(middlewares.TenantMiddleware(registry))
+dp.update.outer_middleware(middlewares.UserMiddleware(mg))
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+dp.message.middleware(middlewares.AccessMiddleware(mg))
+dp.callback_query.middleware(middlewares.AccessMiddleware(mg))
+dp.message.middleware(middlewares.StateMiddleware(mg))
+dp.callback_query.middleware(middlewares.StateMiddleware(mg))
 
 
 
@@ -71,19 +104,49 @@ def get_stats_text(user:api.User) -> str:
     return out
     
 
+def get_lesson_text(event:api.Event) -> str:
+    '''
+    Formats the lesson time, name and rooms, marking
+    substituted and cancelled lessons.
+    '''
+    out = f'{event.start_time.hour}:{event.start_time.minute:0>2}-'\
+        f'{event.end_time.hour}:{event.end_time.minute:0>2}  •  '
+
+    if event.name == None:
+        return out+f'<s>{mg.lessons[event.replaced].name}</s> <i>(отменён)</i>'
+
+    out += f'<b>{mg.lessons[event.name].name}</b> '\
+        f'<i>({", ".join(l.room for l in mg.lessons[event.name].teachers)})</i>'
+    if event.substituted:
+        out += ' 🔄'
+    return out
+
+
+def get_substitution_text(day:api.Day) -> str:
+    '''
+    Returns a line about the substitution on the day
+    or an empty string if there's none.
+    '''
+    if day.substitution == None:
+        return ''
+
+    date = day.substitution.date
+    out = f'🔄 Замены на <b>{date.day} {utils.month(date.month, form=True).lower()}</b>'
+    if day.substitution.comment:
+        out += f': <i>{day.substitution.comment}</i>'
+    return out+'\n\n'
+
+
 def get_schedule_weekday_text(day:api.Day) -> str:
     '''
     Converts the `Day` object to a human-readable
     formatted string.
     '''
     out = [
-        f'{i.start_time.hour}:{i.start_time.minute:0>2}-'\
-        f'{i.end_time.hour}:{i.end_time.minute:0>2}  •  '\
-        f'<b>{mg.lessons[i.name].name}</b> '\
-        f'<i>({", ".join(l.room for l in mg.lessons[i.name].teachers)})</i>'
-        for i in day.events if not i.is_break and i.name != None
+        get_lesson_text(i) for i in day.events
+        if not i.is_break and (i.name != None or i.replaced != None)
     ]
-    return '\n'.join(out)
+    return get_substitution_text(day)+'\n'.join(out)
 
 
 def get_summary_text(day:api.Day, timedata:api.Time) -> str:
@@ -94,10 +157,10 @@ def get_summary_text(day:api.Day, timedata:api.Time) -> str:
     Essentially the same as `get_schedule_weekday_text`, but
     also includes the homework.
     '''
-    out = ''
+    out = get_substitution_text(day)
 
     for index, i in enumerate(day.events):
-        if i.is_break or i.name == None:
+        if i.is_break or (i.name == None and i.replaced == None):
             continue
 
         # symbol
@@ -109,11 +172,9 @@ def get_summary_text(day:api.Day, timedata:api.Time) -> str:
             symbol = '▸' if index == timedata.event_index else ' '
 
         # text
-        out += f'<code>{symbol}</code>'+\
-            f'{i.start_time.hour}:{i.start_time.minute:0>2}-'\
-            f'{i.end_time.hour}:{i.end_time.minute:0>2}  •  '\
-            f'<b>{mg.lessons[i.name].name}</b> '\
-            f'<i>({", ".join(l.room for l in mg.lessons[i.name].teachers)})</i>\n'
+        out += f'<code>{symbol}</code>'+get_lesson_text(i)+'\n'
+        if i.name == None:
+            continue
 
         hw = mg.get_homework(i.name)
         for x in hw:
@@ -133,6 +194,9 @@ def get_time_summary_text(timedata: api.Time, time_until_next_event:int) -> str:
     datestr = f'{timedata.time.day} {utils.month(timedata.time.month, form=True).lower()}'
     out = f'⌚ Сейчас <b>{timestr}, {utils.weekday(timedata.time.weekday())}, {datestr}</b>\n'
 
+    if time_until_next_event == None:
+        return out+'📭 На этой неделе уроков нет\n'
+
     short_time = utils.shorten_time(time_until_next_event)
     if not timedata.is_school:
         out += f'⌛ Школа начнётся через <b>{short_time}</b>'
@@ -165,75 +229,175 @@ def get_homework_text(hw: Dict[str, List[api.HomeworkEntry]]):
     return out
 
 
-def add_overlay(attachment:api.Attachment) -> str:
+def get_search_results(
+    users:List[api.User], offset:int, cursor:int
+) -> Tuple[str, types.InlineKeyboardMarkup]:
+    '''
+    Creates a message with a page of user search results
+    '''
+    page = offset//config.SEARCH_PAGE_SIZE+1
+    out = f'🔍 Найденные пользователи, страница <b>{page}</b>\n\n'\
+        '<i>Нажмите на нужное для просмотра профиля</i>'
+
+    kb = InlineKeyboardBuilder()
+    for user in users:
+        kb.row(types.InlineKeyboardButton(
+            text=f'[{user.company_handle}] {user.company_name}',
+            callback_data=f'profile_{user.id}'
+        ))
+
+    # pages
+    pages = []
+    if offset > 0:
+        pages.append(types.InlineKeyboardButton(
+            text='⬅', callback_data=f'search_{max(0, offset-config.SEARCH_PAGE_SIZE)}'
+        ))
+    if cursor != None:
+        pages.append(types.InlineKeyboardButton(text='➡', callback_data=f'search_{cursor}'))
+    if pages:
+        kb.row(*pages)
+
+    return out, kb.as_markup()
+
+
+def get_overlay_text(attachment:api.Attachment) -> Tuple[str, str, str, str]:
+    '''
+    Returns the comment, lesson name, watermark and author
+    line to put on an attachment.
+    '''
+    written_at = datetime.datetime.fromtimestamp(attachment.written_at)
+    lesson = mg.lessons[attachment.lesson]
+
+    user = mg.get_user(attachment.written_by)
+    if user:
+        user = utils.shorten_string(user.full_name, 25)
+    else:
+        user = f'ID: {attachment.written_by}'
+
+    return (
+        utils.shorten_string(attachment.comment),
+        lesson.name,
+        config.IMAGE_WATERMARK_TEXT,
+        f'От {user} в {utils.shorten_date(written_at)}'
+    )
+
+
+def add_overlay(attachment:api.Attachment, text:Tuple[str, str, str, str], key:str) -> str:
     '''
     Adds overlay to an attachment and returns the file path.
     '''
     log(f'Adding overlay to {attachment.id}')
+    comment, lesson, watermark, author = text
 
     # applying overlay
     shadow_size = 80 # shadow vertical size in pixels
-    written_at = datetime.datetime.fromtimestamp(attachment.written_at)
-    lesson = mg.lessons[attachment.lesson]
 
     image = Image.open(attachment.filename).convert('RGBA')
-    gradient = Image.open('assets/image_shadow.png').convert('RGBA')
-    font = ImageFont.truetype('assets/regular.ttf', 16)
-    bold_font = ImageFont.truetype('assets/bold.ttf', 16)
-
-    gradient = gradient.resize((image.size[0], shadow_size))
+    gradient = shadow_image.resize((image.size[0], shadow_size))
     image.paste(gradient, (0, image.size[1]-shadow_size), gradient)
     draw = ImageDraw.Draw(image)
 
     # comment
-    text = utils.shorten_string(attachment.comment)
-    draw.text((10, image.size[1]-10), text, (255,255,255), bold_font, 'ld')
+    draw.text((10, image.size[1]-10), comment, (255,255,255), bold_font, 'ld')
     # lesson name
-    draw.text((10, image.size[1]-30), lesson.name, (255,255,255), font, 'ld')
+    draw.text((10, image.size[1]-30), lesson, (255,255,255), regular_font, 'ld')
 
     # watermark
     draw.text(
         (image.size[0]-10, image.size[1]-10),
-        config.IMAGE_WATERMARK_TEXT, (255,255,255),
-        font, 'rd'
+        watermark, (255,255,255),
+        regular_font, 'rd'
     )
     # author
-    user = mg.get_user(attachment.written_by)
-    if user:
-        user = utils.shorten_string(user.full_name, 25)
-    else:
-        user = f'ID: {attachment.written_by}'
-
-    string = f'От {user}'\
-        f' в {utils.shorten_date(written_at)}'
     draw.text(
         (image.size[0]-10, image.size[1]-30),
-        string, (255,255,255),
-        font, 'rd'
+        author, (255,255,255),
+        regular_font, 'rd'
     )
 
     # saving the image
     if not os.path.exists('temp/'):
         os.mkdir('temp/')
 
-    savefile = f'temp/{attachment.id}.png'
+    savefile = f'temp/{key}.png'
     image.save(savefile)
     image.close()
 
     return savefile
 
 
-async def download_image(
-    img_id:int, lesson:api.Lesson,
-    comment:str, written_by:types.User
-) -> str:
+def get_notify_text(user:api.User) -> Tuple[str, types.InlineKeyboardMarkup]:
+    '''
+    Creates a message with the notification settings of a user
+    '''
+    out = '🔔 <b>Уведомления о начале уроков</b>\n\n'
+    out += '<i>Выберите, за сколько минут до урока присылать уведомление</i>'
+
+    kb = InlineKeyboardBuilder()
+    for i in config.NOTIFY_OFFSETS:
+        symbol = '✅' if i in user.notifications else '❌'
+        kb.row(types.InlineKeyboardButton(
+            text=f'{symbol} За {i} мин.', callback_data=f'notify_{i}'
+        ))
+
+    return out, kb.as_markup()
+
+
+async def send_notification(id:int, event:api.Event, offset:int):
+    '''
+    Sends a notification about an upcoming lesson
+    '''
+    lesson = mg.lessons[event.name]
+    out = f'🔔 Через <b>{offset} мин.</b> начнётся <b>{lesson.name}</b> '\
+        f'<i>({", ".join(l.room for l in lesson.teachers)})</i>'
+    await bot.send_message(id, out)
+
+
+async def reload_lessons() -> api.LessonsDiff:
     '''
-    Downloads an image via a Telegram attachment ID,
-    adds a watermark and some info, saves it and returns
-    the attachment ID. 
+    Reloads the lesson file and drops renders of
+    everything that changed.
+
+    Returns None if the file is invalid.
+    '''
+    try:
+        diff = await mg.areload_lessons()
+    except Exception as e:
+        log(f'Lesson file is invalid, keeping the old one: {e}', level=ERROR)
+        return None
+
+    if not diff:
+        return diff
+
+    def stale(key) -> bool:
+        if key == 'schedule':
+            return bool(diff.weekdays)
+        if key == 'subjects':
+            return bool(diff.lessons)
+
+        kind, value = key
+        if kind == 'subject':
+            return value in diff.lessons or bool(diff.weekdays)
+        return bool(diff.weekdays) or diff.affects(value)
+
+    lesson_renders.discard(stale)
+    summary_renders.discard(lambda key: diff.affects(key[0]))
+
+    if diff.weekdays or diff.dates:
+        notifier.reschedule()
+    return diff
+
+
+async def download_image(img_id:int, written_by:types.User) -> Tuple[str, str]:
+    '''
+    Downloads an image via a Telegram attachment ID and
+    returns the new attachment ID and the file path.
+
+    The attachment itself isn't added so that it can be
+    added together with the homework.
     '''
     id = utils.rand_id()
-    log(f'Downloading attachment for {lesson.id} homework by {written_by.id}')
+    log(f'Downloading attachment by {written_by.id}')
     
     # downloading file
     try:
@@ -250,10 +414,7 @@ async def download_image(
         log(f'Error while downloading file: {e}', level=ERROR)
         return None
 
-    # adding attachment
-    mg.add_attachment(id, filepath, lesson.id, comment, time.time(), written_by.id)
-
-    return id
+    return id, filepath
 
 
 
@@ -263,17 +424,11 @@ async def download_image(
 # commands
 # ---------------------------
 
-@dp.message(Command(commands=['start', 'help']))
+@dp.message(Command(commands=['start', 'help']), flags={'tenant': None})
 async def cmd_start(msg: types.Message):
     '''
     Help command.
     '''
-    # preparing
-    check = mg.check(msg.from_user)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) started bot / requested help')
 
     # composing message
@@ -292,55 +447,50 @@ async def cmd_summary(msg: types.Message):
     Shows the summary - the schedule for the next lessons, homework
     info, current time info and some more stuff.
     '''
-    # preparing
-    check = mg.check(msg.from_user)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested summary')
     weekday, weekday_index = mg.get_summary()
     weekday: api.Day
     weekday_index: int
-    cur_time = api.Time(weekday, weekday_index)
+    cur_time = api.Time(mg.get_timeline())
 
     if cur_time.is_school:
         time_until_next_event = cur_time.time_remaining
     else:
-        current_time = utils.datetime_to_week(datetime.datetime.now())
-        next_lesson_time = utils.datetime_to_week(weekday.begin_time, weekday_index)
+        time_until_next_event = cur_time.time_until_school
+
+    # the body only changes with the day, the current event and homework
+    def build():
+        out = f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
+        out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
+        out += f'📜 Расписание на <b>{utils.weekday(weekday_index, form=True).lower()}</b>:\n\n'
+        out += get_summary_text(weekday, cur_time)
         
-        # making sure that the next lesson comes after the current time
-        if (next_lesson_time-current_time).total_seconds() < 0:
-            next_lesson_time += datetime.timedelta(days=7)
-        
-        time_until_next_event = (next_lesson_time-current_time).total_seconds()
+        # images
+        kb = InlineKeyboardBuilder()
 
-    # composing message
-    out = get_time_summary_text(cur_time, int(time_until_next_event))
+        for i in mg.get_day_attachments(weekday):
+            # not showing today's homework # FIXME
+            # if datetime.date.fromtimestamp(i.written_at) == datetime.date.today():
+            #     continue
+            # adding homework
+            lesson = mg.lessons[i.lesson]
+            kb.row(types.InlineKeyboardButton(
+                text=f"📷 {lesson.short_name}: {i.comment}",
+                callback_data=f'image_{i.id}'
+            ))
 
-    out += f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
-    out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
-    out += f'📜 Расписание на <b>{utils.weekday(weekday_index, form=True).lower()}</b>:\n\n'
-    out += get_summary_text(weekday, cur_time)
-    
-    # images
-    kb = InlineKeyboardBuilder()
+        return out, kb.as_markup()
 
-    for i in mg.attachments.values():
-        if i.lesson not in weekday.lessons: continue
-        # not showing today's homework # FIXME
-        # if datetime.date.fromtimestamp(i.written_at) == datetime.date.today():
-        #     continue
-        # adding homework
-        lesson = mg.lessons[i.lesson]
-        kb.row(types.InlineKeyboardButton(
-            text=f"📷 {lesson.short_name}: {i.comment}",
-            callback_data=f'image_{i.id}'
-        ))
+    body, kb = summary_renders.get((weekday, cur_time.event_index), build)
+
+    # composing message
+    if time_until_next_event != None:
+        time_until_next_event = int(time_until_next_event)
+    out = get_time_summary_text(cur_time, time_until_next_event)
+    out += body
 
     # sending
-    await msg.reply(out, reply_markup=kb.as_markup())
+    await msg.reply(out, reply_markup=kb)
 
 
 
@@ -349,24 +499,20 @@ async def cmd_schedule(msg: types.Message):
     '''
     Shows the schedule for each available weekday
     '''
-    # preparing
-    check = mg.check(msg.from_user)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested schedule')
 
     # creating keyboard
-    kb = InlineKeyboardBuilder()
-    for i in mg.available_days:
-        kb.add(types.InlineKeyboardButton(
-            text=utils.weekday(i, short=True), callback_data=f'schedule_{i}'
-        ))
+    def build():
+        kb = InlineKeyboardBuilder()
+        for i in mg.available_days:
+            kb.add(types.InlineKeyboardButton(
+                text=utils.weekday(i, short=True), callback_data=f'schedule_{i}'
+            ))
+        return kb.as_markup()
 
     # sending
     out = f'📪 Выберите день недели для отображения расписания'
-    await msg.reply(out, reply_markup=kb.as_markup())
+    await msg.reply(out, reply_markup=lesson_renders.get('schedule', build))
 
 
 
@@ -375,32 +521,28 @@ async def cmd_subject(msg: types.Message):
     '''
     Shows the info about a specific subject
     '''
-    # preparing
-    check = mg.check(msg.from_user)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested subject')
 
     # creating keyboard
-    kb = InlineKeyboardBuilder()
-    index = 3
-    for i in mg.lessons:
-        i = mg.lessons[i]
-        btn = types.InlineKeyboardButton(
-            text=i.name, callback_data=f'subject_{i.id}'
-        )
-        if index >= 2:
-            index = 0
-            kb.row(btn)
-        else:
-            index += 1
-            kb.add(btn)
+    def build():
+        kb = InlineKeyboardBuilder()
+        index = 3
+        for i in mg.lessons:
+            i = mg.lessons[i]
+            btn = types.InlineKeyboardButton(
+                text=i.name, callback_data=f'subject_{i.id}'
+            )
+            if index >= 2:
+                index = 0
+                kb.row(btn)
+            else:
+                index += 1
+                kb.add(btn)
+        return kb.as_markup()
 
     # sending
     out = f'📪 Выберите предмет'
-    await msg.reply(out, reply_markup=kb.as_markup())
+    await msg.reply(out, reply_markup=lesson_renders.get('subjects', build))
 
 
 
@@ -409,12 +551,6 @@ async def cmd_homework(msg: types.Message):
     '''
     Shows the homework for all lessons
     '''
-    # preparing
-    check = mg.check(msg.from_user)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested homework list')
 
     # creating keyboard
@@ -441,11 +577,59 @@ async def cmd_homework(msg: types.Message):
 
 
 
+@dp.message(Command('notify'))
+async def cmd_notify(msg: types.Message):
+    '''
+    Shows the notification settings
+    '''
+    log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested notification settings')
+
+    # sending
+    out, kb = get_notify_text(mg.get_user(msg.from_user.id))
+    await msg.reply(out, reply_markup=kb)
+
+
+
+@dp.message(Command('class'), flags={'tenant': None, 'access': None})
+async def cmd_class(msg: types.Message, command: CommandObject):
+    '''
+    Chooses the class of the chat
+    '''
+    log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested class change')
+
+    if len(registry.specs) == 1:
+        await msg.reply('ℹ Бот обслуживает только один класс')
+        return
+
+    code = (command.args or '').strip()
+    codes = ', '.join(f'<code>{i}</code>' for i in registry.specs)
+
+    if code not in registry.specs:
+        out = f'<b>❌ Использование:</b> <code>/class КЛАСС</code>\n\nДоступные классы: {codes}'
+        await msg.reply(out)
+        return
+
+    # only admins can move group chats
+    if msg.chat.type != 'private' and msg.from_user.id not in config.ADMINS:
+        member = await bot.get_chat_member(msg.chat.id, msg.from_user.id)
+        if member.status not in ['creator', 'administrator']:
+            await msg.reply('❌ Менять класс чата могут только администраторы')
+            return
+
+    registry.bind(msg.chat.id, code)
+
+    # sending
+    await msg.reply(f'✅ Выбран класс <b>{code}</b>')
+
+
+
+
+
 # ---------------------------
 # admin shit
 # ---------------------------
 
-@dp.message(Command('reload'))
+@dp.message(Command('reload'), flags={'access': None})
 async def cmd_reload(msg: types.Message):
     '''
     Shows the basic user stats
@@ -457,9 +641,101 @@ async def cmd_reload(msg: types.Message):
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested reload')
 
     mg.reload_db()
+    mg.start_user_fuzzy_search()
+    diff = await reload_lessons()
+
+    # sending
+    if diff == None:
+        out = f'⚠ База данных перезагружена, но файл с уроками содержит ошибки - смотрите лог'
+    else:
+        out = f'✅ Success!'
+    await msg.reply(out)
+
+
+
+@dp.message(Command('backup'), flags={'access': None})
+async def cmd_backup(msg: types.Message):
+    '''
+    Backs up the database
+    '''
+    # preparing
+    if msg.from_user.id not in config.ADMINS:
+        return
+
+    log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested backup')
+
+    mg.flush()
+    mg.clone_db()
+
+    # sending
+    out = f'✅ Резервная копия создаётся в <code>{mg.backups.folder}</code>'
+    await msg.reply(out)
+
+
+
+@dp.message(Command('acl_add', 'acl_remove'), flags={'access': None})
+async def cmd_acl(msg: types.Message, command: CommandObject):
+    '''
+    Adds users to the blacklist/whitelist or removes them from it
+    '''
+    # preparing
+    if msg.from_user.id not in config.ADMINS:
+        return
+
+    add = command.command == 'acl_add'
+    args = (command.args or '').split()
+
+    # choosing list
+    if args and args[0] == 'write':
+        args = args[1:]
+        collection = 'write_blacklist'
+        name = 'белый список записи' if config.USE_WRITE_WHITELIST else 'чёрный список записи'
+    else:
+        collection = 'blacklist'
+        name = 'белый список' if config.USE_WHITELIST else 'чёрный список'
+
+    # parsing IDs
+    if not args or not all(i.lstrip('-').isdigit() for i in args):
+        await msg.reply(f'<b>❌ Использование:</b> <code>/{command.command} [write] ID ID ...</code>')
+        return
+
+    ids = mg.update_acl(collection, [int(i) for i in args], add)
+    log(f'{msg.from_user.full_name} ({msg.from_user.id}) '\
+        f'{"added" if add else "removed"} {ids} {"to" if add else "from"} {collection}')
+
+    # sending
+    action = 'Добавлено в' if add else 'Удалено из'
+    out = f'✅ {action} {name}: <b>{len(ids)}</b> из <b>{len(args)}</b>'
+    await msg.reply(out)
+
+
+
+@dp.message(Command('metrics'), flags={'access': None, 'throttle': None})
+async def cmd_metrics(msg: types.Message):
+    '''
+    Shows load and rate limiting metrics
+    '''
+    # preparing
+    if msg.from_user.id not in config.ADMINS:
+        return
+
+    log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested metrics')
+
+    # composing message
+    out = f'📊 <b>Метрики</b>\n\n'
+    out += f'Обрабатывается сейчас: <b>{throttling.running}</b>/{throttling.max_concurrent}\n'
+    out += f'Отслеживается лимитов: <b>{len(throttling.buckets)}</b>\n'
+    out += f'Загружено классов: <b>{len(registry.tenants)}</b>/{len(registry.specs)}\n\n'
+    out += f'<b>Отклонено:</b>\n'
+    for reason, amount in throttling.rejected.items():
+        out += f'<code>{reason}</code>: <b>{amount}</b>\n'
+
+    out += f'\n<b>Уведомления:</b>\n'
+    out += f'В очереди: <b>{len(notifier.queue)}</b>\n'
+    out += f'Отправлено: <b>{notifier.sent}</b>\n'
+    out += f'Не удалось отправить: <b>{notifier.failed}</b>\n'
 
     # sending
-    out = f'✅ Success!'
     await msg.reply(out)
 
 
@@ -470,17 +746,11 @@ async def cmd_reload(msg: types.Message):
 # economy command
 # ---------------------------
 
-@dp.message(Command('search'))
+@dp.message(Command('search'), flags={'access': 'write'})
 async def cmd_find_user(msg: types.Message):
     '''
     Searches for user by company handle
     '''
-    # preparing
-    check = mg.check(msg.from_user, True)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) finding user')
     mg.set_state(msg.from_user.id, 'find_user')
 
@@ -496,17 +766,11 @@ async def cmd_find_user(msg: types.Message):
 
 
 
-@dp.message(Command('eco'))
+@dp.message(Command('eco'), flags={'access': 'write'})
 async def cmd_eco(msg: types.Message):
     '''
     Shows the basic user stats
     '''
-    # preparing
-    check = mg.check(msg.from_user, True)
-    if check:
-        await msg.reply(f"❌ {check}")
-        return
-
     log(f'{msg.from_user.full_name} ({msg.from_user.id}) requested eco')
 
     # composing message
@@ -524,17 +788,11 @@ async def cmd_eco(msg: types.Message):
 
 
 
-@dp.callback_query(F.data == 'eco')
+@dp.callback_query(F.data == 'eco', flags={'access': 'write'})
 async def inline_eco(call: types.CallbackQuery):
     '''
     Shows the basic user stats (inline)
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested eco (inline)')
 
     # composing message
@@ -554,17 +812,11 @@ async def inline_eco(call: types.CallbackQuery):
 
 
 
-@dp.callback_query(F.data == 'company')
+@dp.callback_query(F.data == 'company', flags={'access': 'write'})
 async def inline_company(call: types.CallbackQuery):
     '''
     Displays company info
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested company info')
     user = mg.get_user(call.from_user.id)
 
@@ -586,17 +838,11 @@ async def inline_company(call: types.CallbackQuery):
 
 
 
-@dp.callback_query(F.data == 'plot')
+@dp.callback_query(F.data == 'plot', flags={'access': 'write'})
 async def inline_company(call: types.CallbackQuery):
     '''
     Displays company info
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested plot info')
     user = mg.get_user(call.from_user.id)
 
@@ -636,17 +882,11 @@ async def inline_company(call: types.CallbackQuery):
 
 
 
-@dp.callback_query(F.data == 'daily')
+@dp.callback_query(F.data == 'daily', flags={'access': 'write'})
 async def inline_daily(call: types.CallbackQuery):
     '''
     Collects daily reward
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) collecting daily reward')
     user = mg.get_user(call.from_user.id)
 
@@ -672,17 +912,11 @@ async def inline_daily(call: types.CallbackQuery):
 
 
 
-@dp.callback_query(F.data == 'edit_handle')
+@dp.callback_query(F.data == 'edit_handle', flags={'access': 'write'})
 async def inline_edit_handle(call: types.CallbackQuery):
     '''
     Edits company handle
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) editing company handle')
     user = mg.get_user(call.from_user.id)
     
@@ -712,17 +946,11 @@ async def inline_edit_handle(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data == 'edit_name')
+@dp.callback_query(F.data == 'edit_name', flags={'access': 'write'})
 async def inline_edit_name(call: types.CallbackQuery):
     '''
     Edits company name
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) editing company name')
     user = mg.get_user(call.from_user.id)
     mg.set_state(user.id, 'edit_name')
@@ -742,17 +970,11 @@ async def inline_edit_name(call: types.CallbackQuery):
 
 
 
-@dp.callback_query(F.data.startswith('profile_'))
+@dp.callback_query(F.data.startswith('profile_'), flags={'access': 'write'})
 async def inline_profile(call: types.CallbackQuery):
     '''
     Displays profile of a user
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     user = mg.get_user(int(call.data.removeprefix('profile_')))
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested profile info for {user.id}')
 
@@ -768,22 +990,37 @@ async def inline_profile(call: types.CallbackQuery):
 
 
 
+@dp.callback_query(F.data.startswith('search_'), flags={'access': 'write'})
+async def inline_search(call: types.CallbackQuery):
+    '''
+    Switches pages of user search results
+    '''
+    # checking query
+    if call.from_user.id not in mg.searches:
+        await call.answer('❌ Поиск устарел, попробуйте ещё раз', True)
+        return
+
+    offset = int(call.data.removeprefix('search_'))
+    users, cursor = mg.find_user(mg.searches[call.from_user.id], offset)
+    log(f'{call.from_user.full_name} ({call.from_user.id}) opened search results from {offset}')
+
+    # sending
+    out, kb = get_search_results(users, offset, cursor)
+    await call.message.edit_text(out, reply_markup=kb)
+    await call.answer()
+
+
+
 
 # ---------------------------
 # callbacks
 # ---------------------------
 
-@dp.callback_query(F.data == 'homework')
+@dp.callback_query(F.data == 'homework', flags={'access': 'write'})
 async def inline_editor(call: types.CallbackQuery):
     '''
     Shows the homework for all lessons
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested homework list (inline)')
 
     # creating keyboard
@@ -808,17 +1045,11 @@ async def inline_editor(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data == 'hweditor')
+@dp.callback_query(F.data == 'hweditor', flags={'access': 'write'})
 async def inline_editor(call: types.CallbackQuery):
     '''
     Homework editor
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     log(f'{call.from_user.full_name} ({call.from_user.id}) opened homework editor')
 
     # creating keyboard
@@ -842,17 +1073,11 @@ async def inline_editor(call: types.CallbackQuery):
     await call.answer()
     
 
-@dp.callback_query(F.data.startswith('hweditor_'))
+@dp.callback_query(F.data.startswith('hweditor_'), flags={'access': 'write'})
 async def inline_editor_lesson(call: types.CallbackQuery):
     '''
     Action chooser in homework editor
     '''
-    # preparing
-    check = mg.check(call.from_user, True)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     lesson = mg.lessons[call.data.removeprefix('hweditor_')]
     log(f'{call.from_user.full_name} ({call.from_user.id}) opened {lesson.id} in hwe')
     hw = mg.get_homework(lesson.id)
@@ -873,8 +1098,7 @@ async def inline_editor_lesson(call: types.CallbackQuery):
     kb.add(types.InlineKeyboardButton(text='🗑 Удалить', callback_data=f'hwdel_{lesson.id}'))
 
     # images
-    for i in mg.attachments.values():
-        if i.lesson != lesson.id: continue
+    for i in mg.get_attachments(lesson.id):
         kb.row(types.InlineKeyboardButton(
             text=f"📷 {i.comment}",
             callback_data=f'image_{i.id}'
@@ -890,12 +1114,6 @@ async def inline_add_hw(call: types.CallbackQuery):
     '''
     Add homework modal
     '''
-    # preparing
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}", True)
-        return
-
     lesson = mg.lessons[call.data.removeprefix('hwadd_')]
     log(f'{call.from_user.full_name} ({call.from_user.id}) adding homework to {lesson.id}')
 
@@ -924,12 +1142,6 @@ async def inline_del_hw(call: types.CallbackQuery):
     '''
     Delete homework chooser modal
     '''
-    # preparing
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}", True)
-        return
-
     # checking availability
     lesson = mg.lessons[call.data.removeprefix('hwdel_')]
     if not mg.get_homework(lesson.id):
@@ -961,12 +1173,6 @@ async def inline_rem_hw_entry(call: types.CallbackQuery):
     '''
     Delete homework entry callback
     '''
-    # preparing
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}", True)
-        return
-
     # checking availability
     id = call.data.removeprefix('hwrem_')
     if id not in mg.homework:
@@ -994,12 +1200,6 @@ async def inline_erase_hw_entry(call: types.CallbackQuery):
     '''
     Erase all homework entries for one lesson callback
     '''
-    # preparing
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}", True)
-        return
-
     # checking availability
     lesson = mg.lessons[call.data.removeprefix('hwerase_')]
     hw = mg.get_homework(lesson.id)
@@ -1010,9 +1210,10 @@ async def inline_erase_hw_entry(call: types.CallbackQuery):
     out += f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
     out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
     out += 'Список удалённого ДЗ:\n\n'
-    for i in hw:
-        out += utils.hw_to_string(i, False, mg.get_user(i.written_by).name)+'\n'
-        mg.delete_homework(i.id)
+    with mg.transaction():
+        for i in hw:
+            out += utils.hw_to_string(i, False, mg.get_user(i.written_by).name)+'\n'
+            mg.delete_homework(i.id)
 
     # creating keyboard
     kb = InlineKeyboardBuilder()
@@ -1024,17 +1225,38 @@ async def inline_erase_hw_entry(call: types.CallbackQuery):
 
 
 
+@dp.callback_query(F.data.startswith('notify_'))
+async def inline_notify(call: types.CallbackQuery):
+    '''
+    Notification toggle callback
+    '''
+    offset = int(call.data.removeprefix('notify_'))
+    user = mg.get_user(call.from_user.id)
+
+    if offset not in config.NOTIFY_OFFSETS:
+        await call.answer('❌ Такого времени уведомлений нет', show_alert=True)
+        return
+
+    # toggling
+    enabled = offset not in user.notifications
+    if enabled:
+        mg.set_notifications(user.id, [*user.notifications, offset])
+    else:
+        mg.set_notifications(user.id, [i for i in user.notifications if i != offset])
+    log(f'{call.from_user.full_name} ({call.from_user.id}) turned {"on" if enabled else "off"} notifications {offset} minutes before lessons')
+
+    # sending
+    out, kb = get_notify_text(user)
+    await call.message.edit_text(out, reply_markup=kb)
+    await call.answer(f'🔔 Уведомления за {offset} мин. включены' if enabled else f'🔕 Уведомления за {offset} мин. выключены')
+
+
+
 @dp.callback_query(F.data.startswith('schedule_'))
 async def inline_schedule(call: types.CallbackQuery):
     '''
     Schedule info callback
     '''
-    # preparing
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     weekday = int(call.data.removeprefix('schedule_'))
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested schedule for {weekday}')
 
@@ -1046,24 +1268,29 @@ async def inline_schedule(call: types.CallbackQuery):
         )
         return
 
-    data = mg.schedule[weekday]
+    day = mg.get_schedule(weekday)
 
-    # composing message
-    out = f'📜 Расписание на <b>{utils.weekday(weekday, form=True).lower()}</b>:\n'
-    out += f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
-    out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
-    out += get_schedule_weekday_text(data)
+    def build():
+        # composing message
+        out = f'📜 Расписание на <b>{utils.weekday(weekday, form=True).lower()}</b>:\n'
+        out += f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
+        out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
+        out += get_schedule_weekday_text(day)
 
-    # creating keyboard
-    kb = InlineKeyboardBuilder()
-    for i in mg.available_days:
-        kb.add(types.InlineKeyboardButton(
-            text=utils.weekday(i, short=True),
-            callback_data=f'schedule_{i}' if i != weekday else 'noop'
-        ))
+        # creating keyboard
+        kb = InlineKeyboardBuilder()
+        for i in mg.available_days:
+            kb.add(types.InlineKeyboardButton(
+                text=utils.weekday(i, short=True),
+                callback_data=f'schedule_{i}' if i != weekday else 'noop'
+            ))
+
+        return out, kb.as_markup()
 
     # sending
-    await call.message.edit_text(out, reply_markup=kb.as_markup())
+    # days with substitutions are separate objects so they get their own renders
+    out, kb = lesson_renders.get(('schedule', day), build)
+    await call.message.edit_text(out, reply_markup=kb)
     await call.answer()
 
     
@@ -1073,43 +1300,43 @@ async def inline_subject(call: types.CallbackQuery):
     '''
     Subject info callback
     '''
-    # preparing
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
-
     subject = call.data.removeprefix('subject_')
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested subject info for {subject}')
 
     data = mg.lessons[subject]
-    occurences = mg.occurences(subject)
-    joined_occurences = {}
-    for i in occurences:
-        if i[0] not in joined_occurences:
-            joined_occurences[i[0]] = []
-        joined_occurences[i[0]].append(i[1])
 
-    # composing message
-    out = f'📚 <b>{data.name}</b>\n'
-    out += f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
-    out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
-
-    # times
-    if len(occurences) > 0:
-        out += f'📑 Всего <b>{len(occurences)}</b> ур. в неделю:\n'
-        for i in joined_occurences:
-            out += f'•  Стоит {", ".join([f"<b>{k+1}</b>" for k in joined_occurences[i]])} '\
-                f'уроком в <b>{utils.weekday(i, form=True).lower()}</b>\n'
-        out += '\n'
-    else:
-        out += f'📑 <i>Нет уроков</i>\n\n'
+    def build():
+        occurences = mg.occurences(subject)
+        joined_occurences = {}
+        for i in occurences:
+            if i[0] not in joined_occurences:
+                joined_occurences[i[0]] = []
+            joined_occurences[i[0]].append(i[1])
+
+        # composing message
+        out = f'📚 <b>{data.name}</b>\n'
+        out += f'<code>_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _</code>\n'
+        out += f'<code>¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯ ¯</code>\n'
+
+        # times
+        if len(occurences) > 0:
+            out += f'📑 Всего <b>{len(occurences)}</b> ур. в неделю:\n'
+            for i in joined_occurences:
+                out += f'•  Стоит {", ".join([f"<b>{k+1}</b>" for k in joined_occurences[i]])} '\
+                    f'уроком в <b>{utils.weekday(i, form=True).lower()}</b>\n'
+            out += '\n'
+        else:
+            out += f'📑 <i>Нет уроков</i>\n\n'
+
+        # teachers
+        out += '👩‍🏫 Учителя/кабинеты:\n'
+        for i in data.teachers:
+            out += f'•  <b>{i.name}</b> <i>({i.room})</i>\n'
+        out += '\n' 
+        return out
 
-    # teachers
-    out += '👩‍🏫 Учителя/кабинеты:\n'
-    for i in data.teachers:
-        out += f'•  <b>{i.name}</b> <i>({i.room})</i>\n'
-    out += '\n' 
+    # the homework part can change so it's not cached
+    out = lesson_renders.get(('subject', subject), build)
 
     # homework
     if data.homework:
@@ -1128,17 +1355,13 @@ async def inline_subject(call: types.CallbackQuery):
 
     
 
-@dp.callback_query(F.data.startswith('image_'))
+@dp.callback_query(F.data.startswith('image_'), flags={'throttle': 'image'})
 async def inline_attachment(call: types.CallbackQuery):
     '''
     Attachment view callback
     '''
     # preparing
     id = call.data.removeprefix('image_')
-    check = mg.check(call.from_user)
-    if check:
-        await call.answer(f"❌ {check}")
-        return
 
     log(f'{call.from_user.full_name} ({call.from_user.id}) requested image with ID {id}')
 
@@ -1148,25 +1371,40 @@ async def inline_attachment(call: types.CallbackQuery):
         return
     image = mg.attachments[id]
 
-    # sending
-    filename = add_overlay(image)
-    file = types.FSInputFile(filename)
-
     lesson = mg.lessons[image.lesson]
     out = f'🖼 Прикреплённое изображение к ДЗ по уроку <b>{lesson.name}</b>:\n\n'
     out += image.comment
 
-    # keyboard
-    kb = InlineKeyboardBuilder()
-    kb.add(types.InlineKeyboardButton(text='❌ Отмена', callback_data='delete'))
+    # the overlay is rendered and uploaded only once for the same text
+    text = get_overlay_text(image)
+    key = cache.UploadCache.key(image.id, image.filename, *text)
 
-    await call.message.answer_photo(file, out, )
-    await call.answer()
+    async with overlays.lock(key):
+        file_id = overlays.get(key)
 
-    os.remove(filename)
+        # sending the uploaded overlay
+        if file_id != None:
+            try:
+                await call.message.answer_photo(file_id, out)
+                await call.answer()
+                return
+            except TelegramBadRequest as e:
+                log(f'Cached overlay for {image.id} could not be sent: {e}', level=WARNING)
+                overlays.forget(key)
+
+        # rendering and uploading
+        filename = await asyncio.to_thread(add_overlay, image, text, key)
+        try:
+            message = await call.message.answer_photo(types.FSInputFile(filename), out)
+        finally:
+            os.remove(filename)
+
+        overlays.put(key, message.photo[-1].file_id)
+
+    await call.answer()
 
 
-@dp.callback_query(F.data == 'noop')
+@dp.callback_query(F.data == 'noop', flags={'access': None})
 async def noop_callback(call: types.CallbackQuery):
     '''
     Does literally nothing
@@ -1174,7 +1412,7 @@ async def noop_callback(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data == 'delete')
+@dp.callback_query(F.data == 'delete', flags={'access': None})
 async def delete_callback(call: types.CallbackQuery):
     '''
     Deletes a message
@@ -1183,15 +1421,15 @@ async def delete_callback(call: types.CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data == 'reset_state')
-async def reset_state_callback(call: types.CallbackQuery):
+@dp.callback_query(F.data == 'reset_state', flags={'access': None})
+async def reset_state_callback(call: types.CallbackQuery, user_state: str):
     '''
     Reset user state
     '''
-    if mg.get_state(call.from_user.id) == None:
+    # the state is already reset by the time the handler is called
+    if user_state == None:
         await call.answer('❌ Текущих действий нет.', True)
     else:
-        mg.reset_state(call.from_user.id)
         await call.answer('💥 Действие успешно отменено!', True)
 
 
@@ -1203,21 +1441,20 @@ async def reset_state_callback(call: types.CallbackQuery):
 # ---------------------------
 
 
-@dp.message()
-async def state_handler(msg: types.Message):
+@dp.message(flags={'tenant': None, 'access': None})
+async def state_handler(msg: types.Message, user_state: str=None):
     # preparing
+    if tenants.current.get(None) == None: return # chats without a class have no states
     if msg.text != None and msg.text.startswith('/'): return # no commands
     if not msg.photo and msg.text == None: return
 
-    state = mg.get_state(msg.from_user.id)
-    if state == None: state = ''
-    mg.reset_state(msg.from_user.id)
+    state = user_state if user_state != None else ''
 
 
     # homework writing
     if state.startswith('hwadd_'):
         # check
-        check = mg.check(msg.from_user, True)
+        check = mg.acl.check(msg.from_user.id, True)
         if check:
             await msg.reply(f"❌ {check}")
             return
@@ -1241,22 +1478,37 @@ async def state_handler(msg: types.Message):
         attachment = None
 
         # attachment
+        # downloading happens before the transaction so that
+        # nothing is held open while waiting for telegram
         if msg.photo != None:
             loading_msg = await msg.reply('🖼 Загрузка изображения...')
-            attachment = await download_image(
-                msg.photo[-1].file_id, lesson, text, msg.from_user
-            )
+            downloaded = await download_image(msg.photo[-1].file_id, msg.from_user)
 
-            if attachment == None:
+            if downloaded == None:
                 out = '<b>❌ Операция отменена</b>\n\nНе удалось сохранить изображение. Попробуйте ещё раз.'
                 await loading_msg.edit_text(out)
                 mg.set_state(msg.from_user.id, state)
                 return
-            
+
             await loading_msg.delete()
+            attachment, filepath = downloaded
 
         # finishing up
-        mg.add_homework(lesson.id, text, attachment, msg.from_user.id)
+        try:
+            with mg.transaction():
+                if attachment:
+                    mg.add_attachment(
+                        attachment, filepath, lesson.id, text,
+                        time.time(), msg.from_user.id
+                    )
+                mg.add_homework(lesson.id, text, attachment, msg.from_user.id)
+
+        except:
+            # the attachment was never saved so its file isn't needed
+            if attachment and os.path.exists(filepath):
+                os.remove(filepath)
+            raise
+
         log(f'{msg.from_user.full_name} ({msg.from_user.id}) added homework for {lesson.id}: {text}')
 
         # keyboard
@@ -1271,7 +1523,7 @@ async def state_handler(msg: types.Message):
     # handle editing
     elif state == 'edit_handle':
         # check
-        check = mg.check(msg.from_user, True)
+        check = mg.acl.check(msg.from_user.id, True)
         if check:
             await msg.reply(f"❌ {check}")
             return
@@ -1327,7 +1579,7 @@ async def state_handler(msg: types.Message):
     # name editing
     elif state == 'edit_name':
         # check
-        check = mg.check(msg.from_user, True)
+        check = mg.acl.check(msg.from_user.id, True)
         if check:
             await msg.reply(f"❌ {check}")
             return
@@ -1371,17 +1623,41 @@ async def state_handler(msg: types.Message):
     elif state == 'find_user':
         # check
         log(f'{msg.from_user.full_name} ({msg.from_user.id}) searching for user {msg.text}')
-        check = mg.check(msg.from_user, True)
+        check = mg.acl.check(msg.from_user.id, True)
         if check:
             await msg.reply(f"❌ {check}")
             return
         
         # finding user
-        users: List[api.User] = mg.find_user(msg.text)
+        mg.searches[msg.from_user.id] = msg.text
+        users, cursor = mg.find_user(msg.text)
 
+        # looking for similar names if nothing matched
         if users == []:
-            await msg.reply('❌ Пользователей не найдено. Попробуйте ещё раз.')
-            mg.set_state(msg.from_user.id, state)
+            similar = mg.find_user_fuzzy(msg.text)
+
+            if similar == None:
+                await msg.reply('❌ Пользователей не найдено. Поиск похожих имён ещё готовится,'\
+                    ' попробуйте ещё раз через минуту.')
+                mg.set_state(msg.from_user.id, state)
+                return
+
+            if similar == []:
+                await msg.reply('❌ Пользователей не найдено. Попробуйте ещё раз.')
+                mg.set_state(msg.from_user.id, state)
+                return
+
+            out = '🔍 Точных совпадений нет, но есть похожие\n\n'\
+                '<i>Нажмите на нужное для просмотра профиля</i>'
+            kb = InlineKeyboardBuilder()
+
+            for user, score in similar:
+                kb.row(types.InlineKeyboardButton(
+                    text=f'[{user.company_handle}] {user.company_name} • {round(score*100)}%',
+                    callback_data=f'profile_{user.id}'
+                ))
+
+            await msg.reply(out, reply_markup=kb.as_markup())
             return
 
         # getting user profile
@@ -1393,21 +1669,45 @@ async def state_handler(msg: types.Message):
         
         # returning a list of profiles
         else:
-            out = f'🔍 Найдено <b>{len(users)}</b> совпадений\n\n'\
-                '<i>Нажмите на нужное для просмотра профиля</i>'
-            kb = InlineKeyboardBuilder()
+            out, kb = get_search_results(users, 0, cursor)
+            await msg.reply(out, reply_markup=kb)
 
-            for user in users:
-                kb.row(types.InlineKeyboardButton(
-                    text=f'[{user.company_handle}] {user.company_name}',
-                    callback_data=f'profile_{user.id}'
-                ))
 
-            await msg.reply(out, reply_markup=kb.as_markup())
 
+# starting bot
 
+notifier = tenants.TenantLocal(lambda tenant: notifications.Notifier(
+    tenant.manager, send_notification
+)) # upcoming lesson notifications of the class
+lessons_watcher = tenants.TenantLocal(lambda tenant: watcher.FileWatcher(
+    tenant.manager.lessons_file, reload_lessons
+)) # lesson file watcher of the class
 
-# starting bot
+async def start_class():
+    '''
+    Starts background tasks of a freshly loaded class
+    '''
+    await notifier.start()
+    await lessons_watcher.start()
+    mg.start_user_fuzzy_search()
+
+async def stop_class():
+    '''
+    Stops background tasks of a class that is being unloaded
+    '''
+    await notifier.stop()
+    await lessons_watcher.stop()
+
+registry.on_load.append(start_class)
+registry.on_unload.append(stop_class)
+# classes with notifications have to stay loaded to send them
+registry.keep_alive = lambda tenant: any(tenant.manager.subscribers.values())
+dp.startup.register(registry.start)
+dp.shutdown.register(registry.stop)
 
 log('Started polling...')
-asyncio.run(dp.start_polling(bot))
\ No newline at end of file
+try:
+    asyncio.run(dp.start_polling(bot))
+finally:
+    # writing everything that hasn't been written yet
+    registry.flush()
\ No newline at end of file
@@ -0,0 +1,223 @@
+from typing import *
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+import time
+import api
+import tenants
+from log import *
+
+
+# tenants
+
+class TenantMiddleware(BaseMiddleware):
+    def __init__(self, registry:tenants.Tenants):
+        '''
+        Outer middleware that finds the class of the chat an update
+        came from, loading it if needed, and makes it current
+        while the update is handled.
+
+        Updates from chats without a class are handled without one,
+        `AccessMiddleware` only lets them reach handlers with
+        the `tenant` flag set to None.
+        '''
+        self.registry: tenants.Tenants = registry
+
+    async def __call__(
+        self, handler:Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event:types.TelegramObject, data:Dict[str, Any]
+    ) -> Any:
+        chat: types.Chat = data.get('event_chat', None)
+        user: types.User = data.get('event_from_user', None)
+        chat_id = chat.id if chat != None else user.id if user != None else None
+        code = self.registry.code_for(chat_id) if chat_id != None else None
+
+        if code == None:
+            return await handler(event, data)
+
+        tenant = await self.registry.get(code)
+        token = tenants.current.set(tenant)
+        try:
+            return await handler(event, data)
+        finally:
+            tenants.current.reset(token)
+
+
+# user sync
+
+class UserMiddleware(BaseMiddleware):
+    def __init__(self, manager:api.Manager):
+        '''
+        Outer middleware that syncs the user who sent the update
+        and passes them to handlers once per update.
+
+        Handlers get the `User` as `user`.
+        '''
+        self.manager: api.Manager = manager
+
+    async def __call__(
+        self, handler:Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event:types.TelegramObject, data:Dict[str, Any]
+    ) -> Any:
+        user: types.User = data.get('event_from_user', None)
+
+        if user != None and tenants.current.get(None) != None:
+            data['user'] = self.manager.sync_user(user)
+
+        return await handler(event, data)
+
+
+class StateMiddleware(BaseMiddleware):
+    def __init__(self, manager:api.Manager):
+        '''
+        Inner middleware that passes handlers the state the user
+        was in before the update as `user_state` and resets it,
+        like it used to be in `Manager.check`.
+
+        Must be registered after `ThrottlingMiddleware` and
+        `AccessMiddleware`, so the state is kept when they
+        drop the update.
+        '''
+        self.manager: api.Manager = manager
+
+    async def __call__(
+        self, handler:Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event:types.TelegramObject, data:Dict[str, Any]
+    ) -> Any:
+        user: types.User = data.get('event_from_user', None)
+
+        if user != None and tenants.current.get(None) != None:
+            data['user_state'] = self.manager.pop_state(user.id)
+
+        return await handler(event, data)
+
+
+# permissions
+
+class AccessMiddleware(BaseMiddleware):
+    def __init__(self, manager:api.Manager):
+        '''
+        Inner middleware that stops users without permission
+        from reaching handlers.
+
+        Handlers choose the permission with the `access` flag:
+        'read' (default), 'write', or None to skip the check.
+        Handlers that work without a class have the `tenant`
+        flag set to None.
+        '''
+        self.manager: api.Manager = manager
+
+    async def __call__(
+        self, handler:Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event:types.TelegramObject, data:Dict[str, Any]
+    ) -> Any:
+        access = get_flag(data, 'access', default='read')
+        user: types.User = data.get('event_from_user', None)
+
+        if tenants.current.get(None) == None:
+            if get_flag(data, 'tenant', default='required') == None:
+                return await handler(event, data)
+            check = 'Сначала выберите класс: /class'
+
+        elif access == None or user == None:
+            return await handler(event, data)
+
+        else:
+            check = self.manager.acl.check(user.id, access == 'write')
+            if not check:
+                return await handler(event, data)
+
+        # replying with the error
+        if isinstance(event, types.CallbackQuery):
+            await event.answer(f"❌ {check}")
+        else:
+            await event.reply(f"❌ {check}")
+
+
+# rate limiting
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self,
+        limits:Dict[str, Tuple[float, float]]=config.RATE_LIMITS,
+        max_concurrent:int=config.MAX_CONCURRENT_UPDATES
+    ):
+        '''
+        Inner middleware that limits how often each user can
+        reach handlers and how many updates are handled at once.
+
+        Every user has a token bucket per handler class, chosen with
+        the `throttle` flag: 'text' (default), 'image', or None to
+        skip the limit. Updates over the limit or over the
+        concurrency cap are dropped, callbacks get a short answer.
+        '''
+        self.limits: Dict[str, Tuple[float, float]] = limits # tokens per second and bucket size of each handler class
+        self.max_concurrent: int = max_concurrent # maximum amount of updates handled at once
+
+        self.buckets: Dict[Tuple[int, str], Tuple[float, float]] = {} # tokens left and last update time by user and class
+        self.running: int = 0 # amount of updates being handled
+        self.rejected: Dict[str, int] = {i: 0 for i in [*limits, 'overload']} # amount of dropped updates by reason
+
+    def take(self, id:int, kind:str) -> bool:
+        '''
+        Takes a token from the user's bucket.
+
+        Returns False if the bucket is empty.
+        '''
+        rate, size = self.limits[kind]
+        now = time.monotonic()
+        tokens, updated = self.buckets.get((id, kind), (size, now))
+        tokens = min(size, tokens+(now-updated)*rate)
+
+        if tokens < 1:
+            self.buckets[(id, kind)] = (tokens, now)
+            return False
+
+        self.buckets[(id, kind)] = (tokens-1, now)
+        return True
+
+    def clean_up(self):
+        '''
+        Forgets buckets that have refilled completely.
+        '''
+        now = time.monotonic()
+
+        for (id, kind), (tokens, updated) in list(self.buckets.items()):
+            rate, size = self.limits[kind]
+            if tokens+(now-updated)*rate >= size:
+                del self.buckets[(id, kind)]
+
+    async def __call__(
+        self, handler:Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event:types.TelegramObject, data:Dict[str, Any]
+    ) -> Any:
+        kind = get_flag(data, 'throttle', default='text')
+        user: types.User = data.get('event_from_user', None)
+
+        if kind == None or user == None:
+            return await handler(event, data)
+
+        # checking limits
+        if self.running >= self.max_concurrent:
+            reason = 'overload'
+            text = '⏳ Бот перегружен, попробуйте позже'
+        elif not self.take(user.id, kind):
+            reason = kind
+            text = '⏳ Слишком часто, подождите немного'
+        else:
+            reason = None
+
+        if reason:
+            self.rejected[reason] += 1
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text)
+            return
+
+        if len(self.buckets) > config.RATE_LIMIT_MAX_BUCKETS:
+            self.clean_up()
+
+        # handling
+        self.running += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.running -= 1
@@ -0,0 +1,198 @@
+from typing import *
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+import asyncio
+import collections
+import datetime
+import heapq
+import time
+import api
+from log import *
+
+
+# upcoming lesson notifications
+
+class Notifier:
+    def __init__(self,
+        manager:api.Manager,
+        send:Callable[[int, api.Event, int], Awaitable],
+        offsets:List[int]=config.NOTIFY_OFFSETS,
+        rate:int=config.NOTIFY_RATE
+    ):
+        '''
+        Notifies subscribed users about upcoming lessons.
+
+        Every notification time has a single wake-up in a heap,
+        so the amount of timers doesn't depend on the amount of
+        subscribers. When a wake-up comes, the whole bucket of its
+        subscribers is queued and sent out in rate-limited batches.
+
+        `send` gets a user ID, the upcoming lesson and the amount
+        of minutes before it.
+        '''
+        self.manager: api.Manager = manager
+        self.send: Callable[[int, api.Event, int], Awaitable] = send # sends a single notification
+        self.offsets: List[int] = offsets # minutes before lessons users can get notified at
+        self.rate: int = rate # maximum amount of notifications sent per second
+
+        self.heap: List[Tuple[int, int]] = [] # wake-up timestamps with minutes before lessons
+        self.queue: Deque[Tuple[int, api.Event, int]] = collections.deque() # notifications waiting to be sent
+        self.wakeup: asyncio.Event = None # set when the heap changes
+        self.pending: asyncio.Event = None # set when something is queued
+        self.tasks: List[asyncio.Task] = [] # running scheduler and sender
+
+        self.sent: int = 0 # amount of notifications sent
+        self.failed: int = 0 # amount of notifications that couldn't be sent
+
+    def next_wakeup(self, offset:int, after:int) -> Tuple[int, api.Event]:
+        '''
+        Returns the timestamp to notify at about the first
+        lesson that starts at least `offset` minutes after the
+        given timestamp, and the lesson itself.
+
+        The lesson is None if there are no lessons soon.
+        '''
+        timeline = self.manager.get_timeline()
+
+        # all lessons in the next 7 days are cancelled
+        # so checking again tomorrow
+        if not timeline.lesson_starts:
+            return after+24*60*60, None
+
+        moment = datetime.datetime.fromtimestamp(after)
+        seconds = (api.Timeline.to_seconds(moment)+offset*60) % api.WEEK_SECONDS
+
+        until, _, event = timeline.next_lesson(seconds)
+        return after+until, event
+
+    def schedule(self, offset:int, after:int):
+        '''
+        Adds the next wake-up for the notification time to the heap.
+        '''
+        when, _ = self.next_wakeup(offset, after)
+        heapq.heappush(self.heap, (when, offset))
+
+        if self.wakeup:
+            self.wakeup.set()
+
+    def reschedule(self):
+        '''
+        Computes all wake-ups anew. Should be called after
+        the schedule changes.
+        '''
+        self.heap = []
+        for i in self.offsets:
+            self.schedule(i, int(time.time()))
+
+    def fire(self, when:int, offset:int):
+        '''
+        Queues notifications for every subscriber of the
+        notification time.
+        '''
+        expected, event = self.next_wakeup(offset, when)
+
+        # the schedule changed since the wake-up was planned
+        # or the lesson has already started
+        if expected != when or event == None or time.time() >= when+offset*60:
+            return
+
+        subscribers = self.manager.subscribers.get(offset, set())
+        if not subscribers:
+            return
+
+        log(f'Notifying {len(subscribers)} users about {event.name} in {offset} minutes')
+        self.queue.extend((id, event, offset) for id in subscribers)
+        self.pending.set()
+
+    async def run_scheduler(self):
+        '''
+        Sleeps until the closest wake-up and fires it.
+        '''
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            when, offset = self.heap[0]
+            delay = when-time.time()
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            try:
+                self.fire(when, offset)
+            except Exception as e:
+                log(f'Failed to fire notifications: {e}', level=ERROR)
+            self.schedule(offset, max(when+1, int(time.time())))
+
+    async def run_sender(self):
+        '''
+        Sends queued notifications in batches of `rate`
+        notifications per second.
+        '''
+        while True:
+            if not self.queue:
+                self.pending.clear()
+                await self.pending.wait()
+                continue
+
+            started = time.monotonic()
+            batch = [self.queue.popleft() for _ in range(min(self.rate, len(self.queue)))]
+            await asyncio.gather(*[self.deliver(*i) for i in batch])
+
+            await asyncio.sleep(max(0, 1-(time.monotonic()-started)))
+
+    async def deliver(self, id:int, event:api.Event, offset:int):
+        '''
+        Sends a single notification unless the user
+        can't use the bot.
+        '''
+        if self.manager.acl.check(id):
+            return
+
+        try:
+            await self.send(id, event, offset)
+            self.sent += 1
+
+        except TelegramRetryAfter as e:
+            # trying again after telegram lets us
+            await asyncio.sleep(e.retry_after)
+            self.queue.appendleft((id, event, offset))
+
+        except TelegramForbiddenError:
+            # the bot was blocked so there's nobody to notify
+            log(f'User {id} blocked the bot, turning off notifications', level=WARNING)
+            self.manager.set_notifications(id, [])
+            self.failed += 1
+
+        except Exception as e:
+            log(f'Failed to notify user {id}: {e}', level=WARNING)
+            self.failed += 1
+
+    async def start(self):
+        '''
+        Starts the scheduler and the sender.
+        '''
+        self.wakeup = asyncio.Event()
+        self.pending = asyncio.Event()
+        self.reschedule()
+
+        self.tasks = [
+            asyncio.create_task(self.run_scheduler()),
+            asyncio.create_task(self.run_sender())
+        ]
+
+    async def stop(self):
+        '''
+        Stops the scheduler and the sender. Queued
+        notifications are dropped.
+        '''
+        for i in self.tasks:
+            i.cancel()
+        self.tasks = []
@@ -0,0 +1,234 @@
+from typing import *
+
+import bisect
+import re
+import heapq
+import math
+
+
+# prefix index
+
+class PrefixIndex:
+    def __init__(self):
+        '''
+        Finds values by prefixes of their string keys.
+
+        Keys are kept in a sorted array so a lookup costs a binary
+        search plus the amount of matches read.
+        '''
+        self.keys: List[Tuple[str, Any]] = [] # sorted key-value pairs
+        self.values: Dict[Any, List[str]] = {} # keys of every value
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def build(self, items:Iterable[Tuple[Any, Iterable[str]]]):
+        '''
+        Replaces the contents of the index with values and
+        their keys at once.
+        '''
+        self.values = {value: list(keys) for value, keys in items}
+        self.keys = sorted(
+            (key, value) for value, keys in self.values.items() for key in keys
+        )
+
+    def add(self, value:Any, *keys:str):
+        '''
+        Adds keys to a value.
+        '''
+        for key in keys:
+            bisect.insort(self.keys, (key, value))
+        self.values.setdefault(value, []).extend(keys)
+
+    def remove(self, value:Any):
+        '''
+        Removes a value with all its keys.
+        '''
+        for key in self.values.pop(value, []):
+            index = bisect.bisect_left(self.keys, (key, value))
+            if index < len(self.keys) and self.keys[index] == (key, value):
+                del self.keys[index]
+
+    def search(self, prefix:str) -> Iterator[Tuple[str, Any]]:
+        '''
+        Yields key-value pairs whose keys start with the prefix
+        in the order of keys.
+        '''
+        index = bisect.bisect_left(self.keys, (prefix,))
+
+        while index < len(self.keys) and self.keys[index][0].startswith(prefix):
+            yield self.keys[index]
+            index += 1
+
+
+# trigram index
+
+TRANSLITERATION = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '',
+    'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+}) # cyrillic letters to latin ones
+NON_WORD = re.compile(r'[\W_]+') # anything between words
+
+def normalize(text:str) -> str:
+    '''
+    Casefolds and transliterates the text to latin and
+    leaves only words in it.
+    '''
+    text = text.casefold().translate(TRANSLITERATION)
+    return NON_WORD.sub(' ', text).strip()
+
+def trigrams(text:str) -> Set[str]:
+    '''
+    Returns a set of all trigrams in the normalized text.
+    '''
+    text = f'  {text} '
+    return set(map(''.join, zip(text, text[1:], text[2:])))
+
+
+class TrigramIndex:
+    def __init__(self):
+        '''
+        Finds values by strings similar to their string keys
+        with an inverted index of key trigrams.
+
+        Keys are compared after transliteration, so cyrillic
+        and latin spellings of a name match each other. Every
+        word of a key is also indexed as a key of its own. Values
+        with the same key share it, so common names and words
+        are only scored once.
+        '''
+        self.postings: Dict[str, Set[int]] = {} # IDs of keys that contain each trigram
+        self.keys: Dict[int, Tuple[str, Set[Any], Set[str]]] = {} # keys with their values and trigrams by key IDs
+        self.key_ids: Dict[str, int] = {} # key IDs by normalized keys
+        self.values: Dict[Any, List[int]] = {} # IDs of every key of every value
+        self.last_id: int = 0 # last assigned key ID
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def build(self, items:Iterable[Tuple[Any, Iterable[str]]]):
+        '''
+        Replaces the contents of the index with values and
+        their keys at once.
+        '''
+        self.postings = {}
+        self.keys = {}
+        self.key_ids = {}
+        self.values = {}
+
+        for value, keys in items:
+            self.add(value, *keys)
+
+    def add(self, value:Any, *keys:str):
+        '''
+        Adds keys to a value.
+        '''
+        entries = self.values.setdefault(value, [])
+        keys = [normalize(i) for i in keys]
+
+        for key in dict.fromkeys([*keys, *[i for key in keys for i in key.split(' ')]]):
+            if key == '':
+                continue
+
+            key_id = self.key_ids.get(key, None)
+            if key_id == None:
+                self.last_id += 1
+                key_id = self.key_ids[key] = self.last_id
+                grams = trigrams(key)
+                self.keys[key_id] = (key, set(), grams)
+
+                for i in grams:
+                    self.postings.setdefault(i, set()).add(key_id)
+
+            self.keys[key_id][1].add(value)
+            entries.append(key_id)
+
+    def remove(self, value:Any):
+        '''
+        Removes a value with all its keys.
+        '''
+        for key_id in self.values.pop(value, []):
+            key, values, grams = self.keys[key_id]
+            values.discard(value)
+            if values:
+                continue
+
+            # nobody else has the key
+            del self.keys[key_id]
+            del self.key_ids[key]
+            for i in grams:
+                keys = self.postings[i]
+                keys.discard(key_id)
+                if not keys:
+                    del self.postings[i]
+
+    def search(self,
+        query:str, limit:int, threshold:float, max_postings:int=None
+    ) -> List[Tuple[Any, float]]:
+        '''
+        Returns up to `limit` values with keys most similar to
+        the query and their similarity scores, best first.
+
+        Similarity is the Dice coefficient of key and query
+        trigrams, values scoring below `threshold` are left out.
+
+        Keys are read from the rarest trigrams first, and reading
+        stops once the keys left can't beat the best scores found.
+        Once `limit` values are found, trigrams found in more than
+        `max_postings` keys are skipped. Every key read is still
+        scored by all of its trigrams, so only keys that share
+        nothing but very common trigrams with the query can be
+        missed.
+        '''
+        query = normalize(query)
+        if len(query) < 3:
+            return []
+        grams = trigrams(query)
+        postings = sorted((self.postings.get(i, set()) for i in grams), key=len)
+
+        scores: Dict[Any, float] = {}
+        best: List[float] = [] # `limit` best scores so far
+        seen: Set[int] = set()
+
+        for index, keys in enumerate(postings):
+            # a key sharing `shared` trigrams with the query scores at most
+            # 2*shared/(len(grams)+shared), so once the scores are at least
+            # `minimum`, keys that are not in the rarest trigrams can't get in
+            minimum = max(threshold, best[0]) if len(best) == limit else threshold
+            needed = max(1, math.ceil(minimum*len(grams)/(2-minimum)-1e-9))
+            if index > len(grams)-needed:
+                break
+
+            # postings are sorted, so every next trigram is too common
+            if len(best) == limit and max_postings != None and len(keys) > max_postings:
+                break
+
+            keys = keys-seen
+            seen |= keys
+
+            for key_id in keys:
+                _, values, key_grams = self.keys[key_id]
+                score = 2*len(grams & key_grams)/(len(grams)+len(key_grams))
+                if score < minimum:
+                    continue
+
+                for value in values:
+                    # the best scores can't be improved anymore
+                    if len(best) == limit and score <= best[0]:
+                        break
+                    if score <= scores.get(value, 0):
+                        continue
+
+                    # a value can have several keys so only
+                    # its first score gets into the heap
+                    if value not in scores:
+                        if len(best) < limit:
+                            heapq.heappush(best, score)
+                        else:
+                            heapq.heapreplace(best, score)
+                    scores[value] = score
+
+        return heapq.nlargest(limit, scores.items(), key=lambda x: x[1])
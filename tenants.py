@@ -0,0 +1,233 @@
+from typing import *
+
+import asyncio
+import contextvars
+import os
+import time
+import api
+import db
+from log import *
+
+
+# current tenant
+
+current: contextvars.ContextVar["Tenant"] = contextvars.ContextVar('tenant') # tenant of the update being handled
+
+
+class Tenant:
+    def __init__(self, code:str, manager:api.Manager):
+        '''
+        A single class served by the bot with its own lessons
+        and database.
+        '''
+        self.code: str = code # class code
+        self.manager: api.Manager = manager # manager of the class
+        self.used_at: float = time.monotonic() # last time an update for the class was handled
+        self.locals: Dict[TenantLocal, Any] = {} # objects made for this class by `TenantLocal`s
+
+
+class TenantLocal:
+    def __init__(self, factory:Callable[[Tenant], Any]):
+        '''
+        An object that is made separately for every tenant and
+        used as if it was the object of the current tenant.
+
+        Attribute access is forwarded to the object of the tenant
+        set in `current`, so module-level globals can stay globals.
+        '''
+        self.factory: Callable[[Tenant], Any] = factory # makes the object for a tenant
+
+    def resolve(self) -> Any:
+        '''
+        Returns the object of the current tenant.
+        '''
+        tenant = current.get()
+
+        if self not in tenant.locals:
+            tenant.locals[self] = self.factory(tenant)
+        return tenant.locals[self]
+
+    def __getattr__(self, name:str) -> Any:
+        return getattr(self.resolve(), name)
+
+
+# tenant registry
+
+class Tenants:
+    def __init__(self,
+        specs:Dict[str, List[str]]=config.TENANTS,
+        filename:str=config.TENANTS_FILE,
+        idle_timeout:float=config.TENANT_IDLE_TIMEOUT
+    ):
+        '''
+        Hosts many classes in one process.
+
+        Classes are loaded when an update for them comes and unloaded
+        after staying idle for `idle_timeout` seconds, unless
+        `keep_alive` says they have to stay. Chats choose their class
+        once and the choice is kept in `filename`.
+
+        Without any classes in `specs` there's a single class that
+        uses `LESSONS_FILE` and `DB_FILE` and every chat is in it.
+        '''
+        self.specs: Dict[str, List[str]] = specs if specs else {
+            config.DEFAULT_TENANT: [config.LESSONS_FILE, config.DB_FILE]
+        } # paths to lesson and database files by class codes
+        self.filename: str = filename # path to the file with chat classes
+        self.idle_timeout: float = idle_timeout # seconds after which idle classes are unloaded
+
+        self.tenants: Dict[str, Tenant] = {} # loaded classes by codes
+        self.locks: Dict[str, asyncio.Lock] = {} # locks for loading classes
+        self.chats: Dict[int, str] = {} # class codes by chat IDs
+        self.resident: Set[str] = set() # classes that were kept alive when the bot stopped
+
+        self.on_load: List[Callable[[], Awaitable]] = [] # called in the context of every loaded class
+        self.on_unload: List[Callable[[], Awaitable]] = [] # called in the context of every class before it's unloaded
+        self.keep_alive: Callable[[Tenant], bool] = lambda tenant: False # whether the class has to stay loaded
+        self.task: asyncio.Task = None # running evictor
+
+        if os.path.exists(self.filename):
+            data = db.read_snapshot(self.filename)
+            self.chats = {int(k): v for k, v in data.get('chats', {}).items()}
+            self.resident = set(data.get('resident', []))
+
+    def save(self):
+        '''
+        Writes chat classes and resident classes to the file.
+        '''
+        db.write_snapshot(self.filename, {
+            'chats': self.chats, 'resident': sorted(self.resident)
+        })
+
+    def code_for(self, chat_id:int) -> str:
+        '''
+        Returns the code of the chat's class, or None if
+        the chat hasn't chosen one.
+        '''
+        if len(self.specs) == 1:
+            return next(iter(self.specs))
+
+        code = self.chats.get(chat_id, None)
+        return code if code in self.specs else None
+
+    def bind(self, chat_id:int, code:str):
+        '''
+        Puts the chat into a class.
+        '''
+        assert code in self.specs, 'No such class'
+        self.chats[chat_id] = code
+        self.save()
+
+    async def get(self, code:str) -> Tenant:
+        '''
+        Returns a class, loading it first if needed.
+        '''
+        if code not in self.tenants:
+            lock = self.locks.setdefault(code, asyncio.Lock())
+
+            async with lock:
+                if code not in self.tenants:
+                    await self.load(code)
+
+        tenant = self.tenants[code]
+        tenant.used_at = time.monotonic()
+        return tenant
+
+    async def load(self, code:str):
+        '''
+        Loads a class and calls `on_load` for it.
+        '''
+        log(f'Loading class {code}')
+        lessons_file, db_file = self.specs[code]
+        backup_folder = config.BACKUP_FOLDER if len(self.specs) == 1\
+            else os.path.join(config.BACKUP_FOLDER, code)
+
+        manager = await asyncio.to_thread(
+            api.Manager, lessons_file, db_file, backup_folder=backup_folder
+        )
+        tenant = Tenant(code, manager)
+
+        # tasks started here belong to the class
+        token = current.set(tenant)
+        try:
+            for i in self.on_load:
+                await i()
+        finally:
+            current.reset(token)
+
+        self.tenants[code] = tenant
+
+    async def unload(self, code:str):
+        '''
+        Calls `on_unload` for a class, writes its database
+        and forgets it.
+        '''
+        log(f'Unloading class {code}')
+        tenant = self.tenants.pop(code)
+
+        token = current.set(tenant)
+        try:
+            for i in self.on_unload:
+                await i()
+        finally:
+            current.reset(token)
+
+        await asyncio.to_thread(tenant.manager.close)
+
+    async def evict(self):
+        '''
+        Unloads classes that were idle for too long.
+        '''
+        now = time.monotonic()
+
+        for code, tenant in list(self.tenants.items()):
+            if now-tenant.used_at >= self.idle_timeout and not self.keep_alive(tenant):
+                await self.unload(code)
+
+    async def run(self):
+        '''
+        Looks for idle classes every minute.
+        '''
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self.evict()
+            except Exception as e:
+                log(f'Error while unloading classes: {e}', level=ERROR)
+
+    async def start(self):
+        '''
+        Loads classes that were kept alive last time, or the
+        only class if there's one, and starts unloading idle ones.
+        '''
+        codes = self.resident if len(self.specs) > 1 else self.specs
+        for code in codes:
+            if code in self.specs:
+                await self.get(code)
+
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        '''
+        Unloads every class, remembering the ones
+        that have to be loaded on the next start.
+        '''
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+        self.resident = {
+            code for code, tenant in self.tenants.items() if self.keep_alive(tenant)
+        }
+        self.save()
+
+        for code in list(self.tenants):
+            await self.unload(code)
+
+    def flush(self):
+        '''
+        Synchronously writes pending changes of all
+        loaded classes.
+        '''
+        for i in self.tenants.values():
+            i.manager.flush()
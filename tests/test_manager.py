@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import utils # has to be imported before api
+import api
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.folder, 'data.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def manager(self) -> api.Manager:
+        return api.Manager(
+            os.path.join(ROOT, 'lessons.json'), self.db_file,
+            backup_folder=os.path.join(self.folder, 'backups')
+        )
+
+
+    def test_rollback_keeps_hydrated_user_dirty(self):
+        mg = self.manager()
+        mg.put(api.User(1, 'Ivan Ivanov', None))
+        mg.close()
+
+        # a user stored before notifications were added
+        mg = self.manager()
+        del mg.users.raw[1]['notifications']
+        balance = mg.users.raw[1]['balance']
+
+        with self.assertRaises(ValueError):
+            with mg.transaction():
+                mg.users[1].balance += 5
+                raise ValueError()
+
+        self.assertEqual(mg.users[1].balance, balance)
+
+        mg.add_balance(1, 10)
+        mg.close()
+
+        mg = self.manager()
+        self.assertEqual(mg.users[1].balance, balance+10)
+        self.assertEqual(mg.users[1].notifications, [])
+        mg.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+from typing import *
+
+import asyncio
+import os
+from log import *
+
+
+# file watcher
+
+class FileWatcher:
+    def __init__(self,
+        filename:str, callback:Callable[[], Awaitable],
+        interval:float=config.LESSONS_POLL_INTERVAL
+    ):
+        '''
+        Calls back when a file changes.
+
+        The modification time and size of the file are polled, and
+        the callback waits until they stay the same for a whole
+        interval, so half-written files aren't picked up.
+        '''
+        self.filename: str = filename # path to the watched file
+        self.callback: Callable[[], Awaitable] = callback # called when the file changes
+        self.interval: float = interval # seconds between checks
+
+        self.seen: Tuple[int, int] = self.stat() # modification time and size of the file at the last check
+        self.loaded: Tuple[int, int] = self.seen # modification time and size of the file the callback was called for
+        self.task: asyncio.Task = None # running poller
+
+    def stat(self) -> Tuple[int, int]:
+        '''
+        Returns the modification time and size of the file,
+        or None if there's no file.
+        '''
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    async def run(self):
+        '''
+        Checks the file every interval.
+        '''
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self.stat()
+
+            # waiting for the file to stop changing
+            if current != self.seen:
+                self.seen = current
+                continue
+
+            if current == None or current == self.loaded:
+                continue
+
+            self.loaded = current
+            try:
+                await self.callback()
+            except Exception as e:
+                log(f'Error while handling changes in {self.filename}: {e}', level=ERROR)
+
+    async def start(self):
+        '''
+        Starts watching the file.
+        '''
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        '''
+        Stops watching the file.
+        '''
+        if self.task:
+            self.task.cancel()
+            self.task = None